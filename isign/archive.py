@@ -6,16 +6,22 @@
 import abc
 import biplist
 from bundle import App, Bundle, is_info_plist_native
+import clone
+import code_resources
+from digest_store import DigestStore
 from exceptions import MissingHelpers, NotSignable, NotMatched
 from distutils import spawn
 import logging
+import native_zip
 import os
-from os.path import abspath, dirname, exists, isdir, isfile, join, normpath
+from os.path import (abspath, dirname, exists, isdir, isfile, join, normpath,
+                     relpath)
 import tempfile
 import re
 from subprocess import call
 from signer import AdhocSigner, Signer
 import shutil
+import utils
 import zipfile
 
 
@@ -86,6 +92,17 @@ class Archive(object):
     # we use abc.abstractmethod throughout because there are certain class
     # methods we want to ensure are implemented.
 
+    # if True, snapshot file sizes and mtimes as soon as we've unarchived,
+    # so that when sealing we can reuse digests from the app's existing seal
+    # for files we haven't touched. See code_resources.PriorSeal.
+    reuse_prior_seal = False
+
+    def get_snapshot(self, containing_dir):
+        """ snapshot for UncompressedArchive, if we want one """
+        if not self.reuse_prior_seal:
+            return None
+        return code_resources.snapshot_tree(containing_dir)
+
     @abc.abstractmethod
     def unarchive_to_temp(self):
         """ Unarchive and copy to a temp directory """
@@ -159,7 +176,10 @@ class AppArchive(Archive):
         shutil.rmtree(containing_dir)  # quirk of copytree, top dir can't exist already
         shutil.copytree(self.path, containing_dir)
         process_watchkit(containing_dir, REMOVE_WATCHKIT)
-        return UncompressedArchive(containing_dir, '.', self.__class__)
+        return UncompressedArchive(containing_dir,
+                                   '.',
+                                   self.__class__,
+                                   snapshot=self.get_snapshot(containing_dir))
 
 
 class AppZipArchive(Archive):
@@ -168,6 +188,16 @@ class AppZipArchive(Archive):
     app_dir_pattern = r'^([^/]+\.app/).*$'
     extensions = ['.zip']
     helpers = ['zip', 'unzip']
+    # if True, we unzip and zip inside this process, see native_zip.py.
+    # If False, we shell out to the helpers.
+    use_native_zip = True
+    # if True (and zipping natively), members we didn't change are copied
+    # from the original archive as-is, rather than compressed all over again
+    copy_unchanged_members = True
+    # if True (and zipping natively), only extract the files we might rewrite.
+    # The rest are hashed straight out of the archive, and always copied
+    # back from it when repacking.
+    selective_extract = False
 
     @classmethod
     def is_helpers_present(cls):
@@ -219,7 +249,7 @@ class AppZipArchive(Archive):
             recapitulates a very similar precheck in the Bundle class """
         if not isfile(path):
             return False
-        if not cls.is_helpers_present():
+        if not cls.use_native_zip and not cls.is_helpers_present():
             raise MissingHelpers("helpers not present")
         is_native = False
         log.debug('precheck')
@@ -253,15 +283,29 @@ class AppZipArchive(Archive):
 
     def unarchive_to_temp(self):
         containing_dir = make_temp_dir()
-        call([get_helper('unzip'), "-qu", self.path, "-d", containing_dir])
+        zip_source = None
+        if self.use_native_zip:
+            zip_source = native_zip.extract(self.path,
+                                            containing_dir,
+                                            self.selective_extract)
+            if not (self.copy_unchanged_members or self.selective_extract):
+                zip_source = None
+        else:
+            call([get_helper('unzip'), "-qu", self.path, "-d", containing_dir])
         app_dir = abspath(join(containing_dir, self.relative_bundle_dir))
         process_watchkit(app_dir, REMOVE_WATCHKIT)
-        return UncompressedArchive(containing_dir, self.relative_bundle_dir, self.__class__)
+        return UncompressedArchive(containing_dir,
+                                   self.relative_bundle_dir,
+                                   self.__class__,
+                                   zip_source,
+                                   self.get_snapshot(containing_dir))
 
     @classmethod
-    def archive(cls, containing_dir, output_path):
+    def archive(cls, containing_dir, output_path, zip_source=None):
         """ archive this up into a zipfile. Note this is a classmethod, because
-            the caller will use us on a temp directory somewhere """
+            the caller will use us on a temp directory somewhere.
+            If zip_source is given, unchanged members are copied from the
+            archive we originally extracted """
         # the temp file is necessary because zip always adds ".zip" if it
         # does not have an extension. But we want to respect the desired
         # output_path's extension, which could be ".ipa" or who knows.
@@ -275,7 +319,12 @@ class AppZipArchive(Archive):
             # need to chdir and use relative paths, because zip is stupid
             temp_zip_dir = tempfile.mkdtemp(prefix="isign-zip-")
             temp_zip_file = join(temp_zip_dir, 'temp.zip')
-            call([get_helper('zip'), "-qr", temp_zip_file, "."], cwd=containing_dir)
+            if zip_source is not None:
+                native_zip.repack(containing_dir, temp_zip_file, zip_source)
+            elif cls.use_native_zip:
+                native_zip.write_tree(containing_dir, temp_zip_file)
+            else:
+                call([get_helper('zip'), "-qr", temp_zip_file, "."], cwd=containing_dir)
             shutil.move(temp_zip_file, output_path)
             log.info("archived %s to %s" % (cls.__name__, output_path))
         finally:
@@ -298,29 +347,88 @@ class UncompressedArchive(object):
 
         This class is also useful if you have an app that's already unzipped and
         you want to sign it. """
-    def __init__(self, path, relative_bundle_dir, archive_class):
+    # ways to clone, in order of preference; see clone.py
+    clone_methods = clone.CLONE_METHODS
+
+    def __init__(self, path, relative_bundle_dir, archive_class, zip_source=None,
+                 snapshot=None, known_digests=None):
         """ Path is the "Containing dir", the dir at the root level of the unzipped archive
                 (or the dir itself, in the case of an AppArchive archive)
             relative bundle dir is the dir containing the bundle, e.g. Payload/Foo.app
-            archive class is the kind of archive this was (Ipa, etc.) """
+            archive class is the kind of archive this was (Ipa, etc.)
+            zip source, if any, is the native_zip.ZipSource we were extracted from
+            snapshot, if any, is from code_resources.snapshot_tree, taken right
+                after unarchiving
+            known digests, if any, are from hash_resources, maybe in another
+                copy of this archive """
         self.path = path
         self.relative_bundle_dir = relative_bundle_dir
         self.archive_class = archive_class
+        self.zip_source = zip_source
+        self.snapshot = snapshot
+        self.known_digests = known_digests
         bundle_path = normpath(join(path, relative_bundle_dir))
-        self.bundle = App(bundle_path)
+        virtual_files = None
+        checksums = None
+        if zip_source is not None:
+            if zip_source.unextracted:
+                virtual_files = zip_source.get_virtual_files(path)
+            checksums = zip_source.get_checksums(path)
+        bundle_snapshot = None
+        if snapshot is not None:
+            bundle_snapshot = {}
+            for relative_path, state in snapshot.iteritems():
+                bundle_snapshot[join(path, relative_path)] = state
+        hasher = code_resources.ResourceHasher(virtual_files, bundle_snapshot,
+                                               checksums=checksums,
+                                               known_digests=self.get_known_digests())
+        self.bundle = App(bundle_path, hasher)
+
+    def get_known_digests(self):
+        """ known_digests, by absolute path, for our ResourceHasher """
+        if self.known_digests is None:
+            return None
+        known_digests = {}
+        for relative_path, known_digest in self.known_digests.iteritems():
+            known_digests[join(self.path, relative_path)] = known_digest
+        return known_digests
+
+    def hash_resources(self):
+        """ Hash every file in the bundle that signing won't rewrite. Clones
+            of this archive get the digests too, so if we're signing several
+            copies, each only has to hash the files it rewrote """
+        paths = []
+        for root, dirs, filenames in os.walk(self.bundle.path):
+            for filename in filenames:
+                path = join(root, filename)
+                if isfile(path) and not clone.is_rewritten(path):
+                    paths.append(path)
+        states = [code_resources.get_file_state(path) for path in paths]
+        digests = self.bundle.hasher.hash_files(paths)
+        self.known_digests = {}
+        for path, state, digest in zip(paths, states, digests):
+            self.known_digests[relpath(path, self.path)] = (state, digest)
+        self.bundle.hasher.known_digests = self.get_known_digests()
+        log.debug("hashed %d resources in %s", len(paths), self.bundle.path)
 
     def archive(self, output_path):
         """ Re-zip this back up, or simply copy it out, depending on what the
             original archive class did """
-        self.archive_class.archive(self.path, output_path)
+        if self.zip_source is not None:
+            self.archive_class.archive(self.path, output_path, self.zip_source)
+        else:
+            self.archive_class.archive(self.path, output_path)
 
     def clone(self, target_path):
         """ Copy the uncompressed archive somewhere else, return initialized
-            UncompressedArchive """
-        shutil.copytree(self.path, target_path)
+            UncompressedArchive. Copies as little as it can; see clone.py """
+        clone.clone_tree(self.path, target_path, self.clone_methods)
         return self.__class__(target_path,
                               self.relative_bundle_dir,
-                              self.archive_class)
+                              self.archive_class,
+                              self.zip_source,
+                              self.snapshot,
+                              self.known_digests)
 
     def remove(self):
         # the containing dir might be gone already b/c AppArchive simply moves
@@ -359,6 +467,32 @@ def view(input_path):
     return bundle_info
 
 
+def use_digest_store(ua, store):
+    """ Look up digests for this archive's resources in store, if we can.
+        We can only do that for files we extracted from a zip ourselves,
+        since the store needs the CRCs the archive had for them """
+    if ua.zip_source is None:
+        log.warning("not using digest store %s: it only works for zip "
+                    "archives extracted natively, with copy_unchanged_members "
+                    "or selective_extract", store.path)
+        return
+    ua.bundle.hasher.digest_store = store
+
+
+def get_signer(certificate, key, apple_cert, provisioning_profile):
+    """ A Signer for these credentials, or an ad-hoc one if there's no key """
+    if key == None:
+        log.debug('Signing ad-hoc')
+        return AdhocSigner()
+    log.debug('Signing with apple_cert: {}'.format(apple_cert))
+    log.debug('Signing with key: {}'.format(key))
+    log.debug('Signing with certificate: {}'.format(certificate))
+    log.debug('Signing with provisioning_profile: {}'.format(provisioning_profile))
+    return Signer(signer_cert_file=certificate,
+                  signer_key_file=key,
+                  apple_cert_file=apple_cert)
+
+
 def resign(input_path,
            deep,
            certificate,
@@ -367,33 +501,39 @@ def resign(input_path,
            provisioning_profile,
            output_path,
            info_props=None,
-           alternate_entitlements_path=None):
+           alternate_entitlements_path=None,
+           hash_workers=1,
+           digest_store_path=None,
+           signer=None):
     """ Unified interface to extract any kind of archive from
         a temporary file, resign it with these credentials,
-        and create a similar archive for that resigned app """
+        and create a similar archive for that resigned app.
+        hash_workers is how many files to hash at once when sealing.
+        digest_store_path, if given, is an sqlite file of digests to reuse
+        across jobs; see digest_store.DigestStore.
+        signer, if given, is a Signer to use instead of making one from
+        certificate, key and apple_cert, e.g. to share one between jobs """
 
     if not exists(input_path):
         raise IOError("{0} not found".format(input_path))
 
 
-    if key == None:
-        log.debug('Signing ad-hoc')
-        signer = AdhocSigner()
+    if signer is not None:
+        log.debug('Signing with a given signer')
     else:
-        log.debug('Signing with apple_cert: {}'.format(apple_cert))
-        log.debug('Signing with key: {}'.format(key))
-        log.debug('Signing with certificate: {}'.format(certificate))
-        log.debug('Signing with provisioning_profile: {}'.format(provisioning_profile))
-        signer = Signer(signer_cert_file=certificate,
-                        signer_key_file=key,
-                        apple_cert_file=apple_cert)
+        signer = get_signer(certificate, key, apple_cert, provisioning_profile)
     ua = None
     bundle_info = None
+    store = None
     try:
         archive = archive_factory(input_path)
         if archive is None:
             raise NotSignable('No matching archive type found')
         ua = archive.unarchive_to_temp()
+        ua.bundle.hasher.workers = hash_workers
+        if digest_store_path is not None:
+            store = DigestStore(digest_store_path)
+            use_digest_store(ua, store)
         if info_props:
             # Override info.plist props of the parent bundle
             ua.bundle.update_info_props(info_props)
@@ -405,6 +545,90 @@ def resign(input_path,
         log.info(msg)
         raise
     finally:
+        if store is not None:
+            store.close()
         if ua is not None:
             ua.remove()
     return bundle_info
+
+
+def resign_many(input_paths,
+                output_paths,
+                deep,
+                certificate,
+                key,
+                apple_cert,
+                provisioning_profile,
+                info_props=None,
+                alternate_entitlements_path=None,
+                hash_workers=1,
+                digest_store_path=None,
+                signer=None,
+                queue_size=1):
+    """ Like resign, for many apps with the same credentials. Each
+        input path is resigned to the output path at the same position.
+
+        One signer, and one digest store if any, are shared by all the apps.
+        The work is pipelined: while one app is being signed, the next is
+        unarchived and the previous one archived. queue_size is how many
+        apps may wait between those stages, each taking up a temp dir.
+
+        One app failing doesn't stop the others. Returns a list of tuples
+        of (input path, output path, error or None), in order """
+
+    if len(input_paths) != len(output_paths):
+        raise ValueError("{0} input paths, but {1} output paths".format(
+            len(input_paths), len(output_paths)))
+
+    if signer is None:
+        signer = get_signer(certificate, key, apple_cert, provisioning_profile)
+    store = None
+    if digest_store_path is not None:
+        store = DigestStore(digest_store_path)
+
+    # what we know about each app as it goes through the stages
+    jobs = [{'input_path': input_path, 'output_path': output_path, 'ua': None}
+            for input_path, output_path in zip(input_paths, output_paths)]
+
+    def unarchive(job):
+        if not exists(job['input_path']):
+            raise IOError("{0} not found".format(job['input_path']))
+        archive = archive_factory(job['input_path'])
+        if archive is None:
+            raise NotSignable('No matching archive type found')
+        ua = archive.unarchive_to_temp()
+        job['ua'] = ua
+        ua.bundle.hasher.workers = hash_workers
+        if store is not None:
+            use_digest_store(ua, store)
+        if info_props:
+            # Override info.plist props of the parent bundle
+            ua.bundle.update_info_props(info_props)
+
+    def sign(job):
+        job['ua'].bundle.resign(deep, signer, provisioning_profile,
+                                alternate_entitlements_path)
+
+    def archive(job):
+        job['ua'].archive(job['output_path'])
+
+    def remove(job):
+        if job['ua'] is not None:
+            job['ua'].remove()
+
+    try:
+        errors = utils.run_pipeline(jobs, [unarchive, sign, archive],
+                                    queue_size, finish=remove)
+    finally:
+        if store is not None:
+            store.close()
+
+    results = []
+    for job, error in zip(jobs, errors):
+        if error is not None:
+            if isinstance(error, NotSignable):
+                log.info("Not signable: <{0}>: {1}\n".format(job['input_path'], error))
+            else:
+                log.error("resigning %s failed: %s", job['input_path'], error)
+        results.append((job['input_path'], job['output_path'], error))
+    return results
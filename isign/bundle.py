@@ -13,13 +13,15 @@ import biplist
 import code_resources
 from exceptions import NotMatched
 import copy
+from functools import partial
 import glob
 import logging
 import os
 from os.path import basename, exists, join, splitext
-from signer import openssl_command
+import provisioning_profile
 import signable
 import shutil
+import utils
 
 
 log = logging.getLogger(__name__)
@@ -43,9 +45,15 @@ class Bundle(object):
     helpers = []
     signable_class = None
     entitlements_path = None  # Not set for every bundle type
+    # How many nested frameworks, dylibs and app extensions to sign at
+    # once, when signing deep. Only our own seal has to wait for them
+    sign_workers = 4
 
-    def __init__(self, path):
+    def __init__(self, path, hasher=None):
+        """ hasher: a code_resources.ResourceHasher, shared with
+            any bundles within this one """
         self.path = path
+        self.hasher = hasher
         self.info_path = join(self.path, 'Info.plist')
         if not exists(self.info_path):
             raise NotMatched("no Info.plist found; probably not a bundle")
@@ -103,6 +111,7 @@ class Bundle(object):
 
         if changed:
             biplist.writePlist(self.info, self.info_path, binary=True)
+            code_resources.invalidate_hash(self.info_path)
         else:
             self.orig_info = None
 
@@ -120,54 +129,66 @@ class Bundle(object):
     def get_info_prop(self, key):
         return self.info[key]
 
-    def sign_dylibs(self, signer, path):
-        """ Sign all the dylibs in this directory """
-        for dylib_path in glob.glob(join(path, '*.dylib')):
-            dylib = signable.Dylib(self, dylib_path, signer)
-            dylib.sign(self, signer)
+    def sign_dylib(self, signer, dylib_path):
+        dylib = signable.Dylib(self, dylib_path, signer)
+        dylib.sign(self, signer)
+
+    def sign_appex(self, signer, appex_exec_path):
+        appex = signable.Appex(self, appex_exec_path, signer)
+        appex.sign(self, signer)
+
+    def get_nested_jobs(self, deep, signer):
+        """ Everything in this bundle that has to be signed before we
+            seal it, as functions to call. Nested frameworks are signed
+            deep, if deep is specified. None of them depend on each other """
+        jobs = []
+        frameworks_path = join(self.path, 'Frameworks')
+        if exists(frameworks_path):
+            # log.debug("SIGNING FRAMEWORKS: %s" % frameworks_path)
+            # sign all the frameworks
+            for framework_name in sorted(os.listdir(frameworks_path)):
+                framework_path = join(frameworks_path, framework_name)
+                # log.debug("checking for framework: %s" % framework_path)
+                try:
+                    framework = Framework(framework_path, self.hasher)
+                except NotMatched:
+                    # log.debug("not a framework: %s" % framework_path)
+                    continue
+                jobs.append(partial(framework.resign, deep, signer))
+            # sign all the dylibs under Frameworks
+            for dylib_path in sorted(glob.glob(join(frameworks_path, '*.dylib'))):
+                jobs.append(partial(self.sign_dylib, signer, dylib_path))
+
+        # sign any dylibs in the main directory (rare, but it happens)
+        for dylib_path in sorted(glob.glob(join(self.path, '*.dylib'))):
+            jobs.append(partial(self.sign_dylib, signer, dylib_path))
+
+        plugins_path = join(self.path, 'PlugIns')
+        if exists(plugins_path):
+            # sign the appex executables
+            appex_paths = glob.glob(join(plugins_path, '*.appex'))
+            for appex_path in sorted(appex_paths):
+                plist_path = join(appex_path, 'Info.plist')
+                if not exists(plist_path):
+                    continue
+                plist = biplist.readPlist(plist_path)
+                appex_exec_path = join(appex_path, plist['CFBundleExecutable'])
+                jobs.append(partial(self.sign_appex, signer, appex_exec_path))
+        return jobs
 
     def sign(self, deep, signer):
         """ Sign everything in this bundle.  If deep is specified, sign
         recursively with sub-bundles """
         # log.debug("SIGNING: %s" % self.path)
         if deep:
-            frameworks_path = join(self.path, 'Frameworks')
-            if exists(frameworks_path):
-                # log.debug("SIGNING FRAMEWORKS: %s" % frameworks_path)
-                # sign all the frameworks
-                for framework_name in os.listdir(frameworks_path):
-                    framework_path = join(frameworks_path, framework_name)
-                    # log.debug("checking for framework: %s" % framework_path)
-                    try:
-                        framework = Framework(framework_path)
-                        # log.debug("resigning: %s" % framework_path)
-                        framework.resign(deep, signer)
-                    except NotMatched:
-                        # log.debug("not a framework: %s" % framework_path)
-                        continue
-                # sign all the dylibs under Frameworks
-                self.sign_dylibs(signer, frameworks_path)
-
-            # sign any dylibs in the main directory (rare, but it happens)
-            self.sign_dylibs(signer, self.path)
-
-            plugins_path = join(self.path, 'PlugIns')
-            if exists(plugins_path):
-                # sign the appex executables
-                appex_paths = glob.glob(join(plugins_path, '*.appex'))
-                for appex_path in appex_paths:
-                    plist_path = join(appex_path, 'Info.plist')
-                    if not exists(plist_path):
-                        continue
-                    plist = biplist.readPlist(plist_path)
-                    appex_exec_path = join(appex_path, plist['CFBundleExecutable'])
-                    appex = signable.Appex(self, appex_exec_path, signer)
-                    appex.sign(self, signer)
+            jobs = self.get_nested_jobs(deep, signer)
+            utils.map_threaded(lambda job: job(), jobs, self.sign_workers)
 
         # then create the seal
         # TODO maybe the app should know what its seal path should be...
         self.seal_path = code_resources.make_seal(self.get_executable_path(),
-                                                  self.path)
+                                                  self.path,
+                                                  self.hasher)
         # then sign the app
         executable = self.signable_class(self, self.get_executable_path(), signer)
         executable.sign(self, signer)
@@ -187,8 +208,8 @@ class Framework(Bundle):
     # the executable in this bundle will be a Framework
     signable_class = signable.Framework
 
-    def __init__(self, path):
-        super(Framework, self).__init__(path)
+    def __init__(self, path, hasher=None):
+        super(Framework, self).__init__(path, hasher)
 
 
 class App(Bundle):
@@ -199,8 +220,8 @@ class App(Bundle):
     # executable of an app)
     signable_class = signable.Executable
 
-    def __init__(self, path):
-        super(App, self).__init__(path)
+    def __init__(self, path, hasher=None):
+        super(App, self).__init__(path, hasher)
         self.entitlements_path = join(self.path,
                                       'Entitlements.plist')
         self.provision_path = join(self.path,
@@ -208,33 +229,24 @@ class App(Bundle):
 
     def provision(self, provision_path):
         shutil.copyfile(provision_path, self.provision_path)
+        code_resources.invalidate_hash(self.provision_path)
 
     @staticmethod
     def extract_entitlements(provision_path):
         """ Given a path to a provisioning profile, return the entitlements
             encoded therein """
-        cmd = [
-            'smime',
-            '-inform', 'der',
-            '-verify',    # verifies content, prints verification status to STDERR,
-                          #  outputs content to STDOUT. In our case, will be an XML plist
-            '-noverify',  # accept self-signed certs. Not the opposite of -verify!
-            '-in', provision_path
-        ]
-        # this command always prints 'Verification successful' to stderr.
-        (profile_text, err) = openssl_command(cmd, data=None, expect_err=True)
-        if err and err.strip() != 'Verification successful':
-            log.error('Received unexpected error from openssl: {}'.format(err))
-        plist_dict = biplist.readPlistFromString(profile_text)
-        if 'Entitlements' not in plist_dict:
+        profile = provisioning_profile.load(provision_path)
+        if profile.entitlements is None:
             log.debug('failed to get entitlements in provisioning profile')
             raise Exception('could not find Entitlements in {}'.format(provision_path))
-        return plist_dict['Entitlements']
+        # the profile is cached, so don't hand out what's in it
+        return copy.deepcopy(profile.entitlements)
 
     def write_entitlements(self, entitlements):
         """ Write entitlements to self.entitlements_path. This actually doesn't matter
             to the app, it's just used later on by other parts of the signing process. """
         biplist.writePlist(entitlements, self.entitlements_path, binary=False)
+        code_resources.invalidate_hash(self.entitlements_path)
         log.debug("wrote Entitlements to {0}".format(self.entitlements_path))
 
     def resign(self, deep, signer, provisioning_profile, alternate_entitlements_path=None):
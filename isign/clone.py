@@ -0,0 +1,108 @@
+""" Makes copies of an unarchived app cheaply, for signing it again with
+    other credentials.
+
+    We try, in order:
+
+    - reflinks: copy-on-write clones of every file, on filesystems that
+      can do that (btrfs, XFS). Practically free, and nothing is shared
+      that could be written to.
+    - hardlinks: every file is linked to the original, except the ones
+      that isign rewrites (executables, libraries, plists, seals, profiles),
+      which are copied. So only those take up more space.
+    - plain copies of everything.
+
+    Files in a hardlinked clone must never be written in place, or the
+    original would change as well. isign only rewrites the files we copy,
+    and checks the link count before signing in place anyway. """
+
+import errno
+import fcntl
+import logging
+import os
+from os.path import basename, isdir, join, splitext
+import shutil
+from native_zip import MACHO_MAGICS, SELECTIVE_NAMES, SELECTIVE_EXTENSIONS
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+CLONE_METHODS = ['reflink', 'hardlink', 'copy']
+# These are rewritten during signing, if present
+REWRITTEN_NAMES = SELECTIVE_NAMES + ['Entitlements.plist']
+# errors meaning this way of cloning won't work here
+UNSUPPORTED_ERRNOS = set([errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                          errno.EINVAL, errno.ENOSYS, errno.EPERM,
+                          errno.EMLINK])
+
+log = logging.getLogger(__name__)
+
+
+class CloneNotSupported(Exception):
+    pass
+
+
+def is_rewritten(path):
+    """ Might isign write to this file when signing? """
+    if basename(path) in REWRITTEN_NAMES:
+        return True
+    if splitext(path)[1] in SELECTIVE_EXTENSIONS:
+        return True
+    with open(path, 'rb') as fh:
+        return fh.read(4) in MACHO_MAGICS
+
+
+def reflink(source, target):
+    with open(source, 'rb') as source_fh:
+        with open(target, 'wb') as target_fh:
+            try:
+                fcntl.ioctl(target_fh.fileno(), FICLONE, source_fh.fileno())
+            except IOError as e:
+                if e.errno in UNSUPPORTED_ERRNOS:
+                    raise CloneNotSupported(e)
+                raise
+    shutil.copystat(source, target)
+
+
+def hardlink(source, target):
+    if is_rewritten(source):
+        shutil.copy2(source, target)
+        return
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno in UNSUPPORTED_ERRNOS:
+            raise CloneNotSupported(e)
+        raise
+
+
+CLONE_FUNCTIONS = {
+    'reflink': reflink,
+    'hardlink': hardlink,
+    'copy': shutil.copy2
+}
+
+
+def clone_files(source, target, clone_function):
+    """ Like shutil.copytree, cloning each file with clone_function """
+    os.makedirs(target)
+    for name in os.listdir(source):
+        source_path = join(source, name)
+        target_path = join(target, name)
+        if isdir(source_path):
+            clone_files(source_path, target_path, clone_function)
+        else:
+            clone_function(source_path, target_path)
+    shutil.copystat(source, target)
+
+
+def clone_tree(source, target, methods=CLONE_METHODS):
+    """ Clone the directory source to target, which mustn't exist, using
+        the first of these methods that works here. Returns the method """
+    for method in methods:
+        try:
+            clone_files(source, target, CLONE_FUNCTIONS[method])
+            log.debug("cloned %s to %s with %s", source, target, method)
+            return method
+        except CloneNotSupported as e:
+            log.debug("can't clone with %s: %s", method, e)
+            shutil.rmtree(target, ignore_errors=True)
+    raise CloneNotSupported("no way to clone {0}".format(source))
@@ -1,18 +1,28 @@
 import binascii
+from collections import OrderedDict
 import copy
+import digest_store
 import hashlib
 import logging
-from memoizer import memoize
 import os
 import plistlib
 from plistlib import PlistWriter
 import re
+import threading
+import utils
 
 OUTPUT_DIRECTORY = '_CodeSignature'
 OUTPUT_FILENAME = 'CodeResources'
 TEMPLATE_FILENAME = 'code_resources_template.xml'
 # DIGEST_ALGORITHM = "sha1"
 HASH_BLOCKSIZE = 65536
+# if True, hash files even when a prior seal has a digest we could reuse,
+# and complain if they differ. For the paranoid.
+VERIFY_PRIOR_SEAL = False
+# how many file digests to keep in the hash cache
+HASH_CACHE_SIZE = 10000
+# rules with these can't be combined into one regex; see RuleMatcher
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
 
 log = logging.getLogger(__name__)
 
@@ -88,18 +98,245 @@ class PathRule(object):
         return 'PathRule:' + str(self.flags) + ':' + str(self.weight)
 
 
+class RuleMatcher(object):
+    """ Finds the rule for a path, as ResourceBuilder.find_rule_linear does,
+        but with one regex match rather than one per rule.
+
+        All the rules that could win go into a single alternation, ordered
+        so that the first alternative to match is the winner: exclusions
+        first, then by weight, highest first. Among equal weights the
+        earlier rule wins, as in the linear search. Rules with no weight can
+        never beat the null rule, so they're left out. """
+
+    def __init__(self, rules, null_rule):
+        self.null_rule = null_rule
+        exclusions = [rule for rule in rules if rule.is_exclusion()]
+        weighted = [rule for rule in rules
+                    if not rule.is_exclusion() and rule.weight > null_rule.weight]
+        # sort is stable, so ties stay in their original order
+        weighted.sort(key=lambda rule: -rule.weight)
+        ordered_rules = exclusions + weighted
+
+        # map every group number in the combined regex to the rule it's
+        # part of, so we can tell which alternative matched
+        self.rules_by_group = {}
+        alternatives = []
+        group = 1
+        for rule in ordered_rules:
+            alternatives.append('(' + rule.pattern.pattern + ')')
+            for i in range(group, group + rule.pattern.groups + 1):
+                self.rules_by_group[i] = rule
+            group += rule.pattern.groups + 1
+        self.regex = None
+        if not ordered_rules:
+            return
+        if any(BACKREFERENCE.search(rule.pattern.pattern) for rule in ordered_rules):
+            # renumbering groups would break these
+            log.debug("backreferences in rules, matching them one by one")
+            return
+        try:
+            self.regex = re.compile('|'.join(alternatives), re.IGNORECASE)
+        except (re.error, AssertionError, OverflowError):
+            # e.g. too many groups for one regex
+            log.debug("could not combine rules, matching them one by one")
+
+    def is_combined(self):
+        return self.regex is not None
+
+    def find_rule(self, path):
+        """ the best rule for this path. Only call this if is_combined() """
+        match = self.regex.match(path)
+        if match is None:
+            return self.null_rule
+        return self.rules_by_group[match.lastindex]
+
+
+def get_file_state(path):
+    """ Cheap way to tell if a file has changed """
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime)
+
+
+def snapshot_tree(path):
+    """ Map of path relative to this directory -> state of every file
+        within it. See PriorSeal """
+    snapshot = {}
+    for root, dirs, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(root, filename)
+            if os.path.isfile(file_path):
+                relative_path = os.path.relpath(file_path, path)
+                snapshot[relative_path] = get_file_state(file_path)
+    return snapshot
+
+
+class PriorSeal(object):
+    """ The digests in a bundle's existing CodeResources seal. We can trust
+        these for files whose size and mtime are what they were when the
+        bundle was extracted, i.e. files we haven't touched since. """
+
+    def __init__(self, seal_path, snapshot):
+        """ snapshot is a map of path -> state, from get_file_state """
+        self.seal_path = seal_path
+        self.snapshot = snapshot
+        self.digests = {}
+        plist = plistlib.readPlist(seal_path)
+        for key in ['files', 'files2']:
+            for relative_path, val in plist.get(key, {}).iteritems():
+                if isinstance(val, dict):
+                    # files2 may only have a sha256 'hash2', we can't use that
+                    val = val.get('hash')
+                if isinstance(val, plistlib.Data):
+                    self.digests.setdefault(relative_path, val.data)
+
+    def get_hash_binary(self, path, relative_path):
+        """ Digest for this file, or None if we can't vouch for it """
+        digest = self.digests.get(relative_path)
+        if digest is None or path not in self.snapshot:
+            return None
+        if get_file_state(path) != self.snapshot[path]:
+            return None
+        return digest
+
+
+class ResourceHasher(object):
+    """ Gets the digests of files in a bundle tree, for sealing. One of these
+        is shared by a bundle and all the bundles nested within it. """
+
+    # hashlib releases the GIL while hashing large buffers, so by default we
+    # hash with threads, using utils.map_threaded. To use processes instead,
+    # set this to multiprocessing.Pool; a pool is made for each seal.
+    pool_class = None
+
+    def __init__(self, virtual_files=None, snapshot=None, workers=1,
+                 checksums=None, digest_store=None, known_digests=None):
+        """ virtual_files, if given, is a map of path -> binary digest of files
+                which belong in the tree but aren't on disk, e.g. because they
+                were left in an archive. They're sealed as if they were present.
+            snapshot, if given, is a map of path -> state (see get_file_state)
+                from when the tree was extracted. Digests in existing seals are
+                reused for files that haven't changed since. See PriorSeal.
+            workers is how many files to hash at once.
+            checksums, if given, is a map of path -> (state, CRC32) of files
+                extracted from an archive. With a digest_store, a
+                digest_store.DigestStore, we look those files up before
+                hashing them.
+            known_digests, if given, is a map of path -> (state, digest) of
+                files already hashed, e.g. in another copy of this tree. We
+                use those digests for files still in the same state. """
+        self.virtual_files = {}
+        self.virtual_filenames = {}
+        if virtual_files is not None:
+            for path, digest in virtual_files.iteritems():
+                root, filename = os.path.split(path)
+                self.virtual_files[path] = digest
+                self.virtual_filenames.setdefault(root, []).append(filename)
+        self.snapshot = snapshot
+        self.workers = workers
+        self.checksums = checksums
+        self.digest_store = digest_store
+        self.known_digests = known_digests
+
+    def get_virtual_filenames(self, root):
+        """ names of virtual files directly within this directory """
+        return self.virtual_filenames.get(root, [])
+
+    def get_virtual_hash_binary(self, path):
+        """ digest of a virtual file, or None if it isn't one """
+        if path in self.virtual_files and not os.path.lexists(path):
+            return self.virtual_files[path]
+        return None
+
+    def get_prior_seal(self, seal_path):
+        """ PriorSeal for the seal at this path, if we can use one """
+        if self.snapshot is None or not os.path.exists(seal_path):
+            return None
+        return PriorSeal(seal_path, self.snapshot)
+
+    def get_known_digest(self, path):
+        """ digest from known_digests, or None if we don't have one
+            for the file as it is now """
+        if self.known_digests is None or path not in self.known_digests:
+            return None
+        state, digest = self.known_digests[path]
+        if get_file_state(path) != state:
+            return None
+        return digest
+
+    def get_fingerprint(self, path):
+        """ fingerprint to look this file up in the digest store by,
+            or None if we can't look it up """
+        if (self.digest_store is None or self.checksums is None or
+                path not in self.checksums):
+            return None
+        state, crc = self.checksums[path]
+        size = state[0]
+        if size < digest_store.MIN_SIZE or get_file_state(path) != state:
+            return None
+        return digest_store.get_fingerprint(path, size, crc)
+
+    def hash_files(self, paths):
+        """ digests of these files, in the same order """
+        digests = []
+        fingerprints = {}
+        to_hash = []
+        for i, path in enumerate(paths):
+            digest = self.get_known_digest(path)
+            fingerprint = None
+            if digest is None:
+                fingerprint = self.get_fingerprint(path)
+            if fingerprint is not None:
+                digest = self.digest_store.get(fingerprint)
+                if digest is None:
+                    fingerprints[i] = fingerprint
+            if digest is None:
+                to_hash.append(i)
+            digests.append(digest)
+
+        hashed_digests = self._hash_files([paths[i] for i in to_hash])
+        for i, digest in zip(to_hash, hashed_digests):
+            if i in fingerprints:
+                self.digest_store.put(fingerprints[i], digest)
+            digests[i] = digest
+        return digests
+
+    def _hash_files(self, paths):
+        if self.workers <= 1 or len(paths) <= 1:
+            return [get_hash_binary(path) for path in paths]
+        if self.pool_class is None:
+            return utils.map_threaded(hash_file, paths, self.workers)
+        pool = self.pool_class(min(self.workers, len(paths)))
+        try:
+            return pool.map(hash_file, paths)
+        finally:
+            pool.close()
+            pool.join()
+
+
 class ResourceBuilder(object):
     NULL_PATH_RULE = PathRule()
 
-    def __init__(self, app_path, rules_data, respect_omissions=False):
+    def __init__(self, app_path, rules_data, hasher=None, prior_seal=None):
+        """ hasher, if given, is a ResourceHasher.
+            prior_seal, if given, is a PriorSeal whose digests we may reuse. """
         self.app_path = app_path
+        if hasher is None:
+            hasher = ResourceHasher()
+        self.hasher = hasher
+        self.prior_seal = prior_seal
         self.app_dir = os.path.dirname(app_path)
         self.rules = []
-        self.respect_omissions = respect_omissions
         for pattern, properties in rules_data.iteritems():
             self.rules.append(PathRule(pattern, properties))
+        self.rule_matcher = RuleMatcher(self.rules,
+                                        ResourceBuilder.NULL_PATH_RULE)
 
     def find_rule(self, path):
+        if self.rule_matcher.is_combined():
+            return self.rule_matcher.find_rule(path)
+        return self.find_rule_linear(path)
+
+    def find_rule_linear(self, path):
         best_rule = ResourceBuilder.NULL_PATH_RULE
         for rule in self.rules:
             # log.debug('trying rule ' + str(rule) + ' against ' + path)
@@ -117,15 +354,49 @@ class ResourceBuilder(object):
         rule = self.find_rule(relative_path)
         return (rule, path, relative_path)
 
+    def get_hash_binaries(self, paths):
+        """ Get the digests of files in the bundle, given a list of
+            (path, relative path). Avoids hashing what we can, and hashes the
+            rest all at once. Returns digests in the same order """
+        digests = []
+        expected_digests = {}
+        to_hash = []
+        for i, (path, relative_path) in enumerate(paths):
+            digest = self.hasher.get_virtual_hash_binary(path)
+            if digest is None and self.prior_seal is not None:
+                digest = self.prior_seal.get_hash_binary(path, relative_path)
+                if digest is not None and VERIFY_PRIOR_SEAL:
+                    expected_digests[i] = digest
+                    digest = None
+            if digest is None:
+                to_hash.append(i)
+            digests.append(digest)
+
+        hashed_digests = self.hasher.hash_files([paths[i][0] for i in to_hash])
+        for i, digest in zip(to_hash, hashed_digests):
+            if i in expected_digests and expected_digests[i] != digest:
+                log.warning("prior seal has wrong digest for %s", paths[i][0])
+            digests[i] = digest
+        return digests
+
     def scan(self):
         """
-        Walk entire directory, compile mapping
-        path relative to source_dir -> digest and other data
+        Walk entire directory, compile mappings
+        path relative to source_dir -> digest and other data.
+
+        Returns two mappings, for the 'files' and 'files2' keys of the seal.
+        They differ only in that the latter leaves out files that the rules
+        say to omit, so we do both in one pass, hashing each file once.
         """
-        file_entries = {}
+        # first find the files we want, then hash them all at once
+        rules = []
+        paths = []
         # rule_debug_fmt = "rule: {0}, path: {1}, relative_path: {2}"
         for root, dirs, filenames in os.walk(self.app_dir):
             # log.debug("root: {0}".format(root))
+            for filename in self.hasher.get_virtual_filenames(root):
+                if filename not in filenames:
+                    filenames.append(filename)
             for filename in filenames:
                 rule, path, relative_path = self.get_rule_and_paths(root,
                                                                     filename)
@@ -134,22 +405,11 @@ class ResourceBuilder(object):
                 if rule.is_exclusion():
                     continue
 
-                if rule.is_omitted() and self.respect_omissions is True:
-                    continue
-
                 if self.app_path == path:
                     continue
 
-                # the Data element in plists is base64-encoded
-                val = {'hash': plistlib.Data(get_hash_binary(path))}
-
-                if rule.is_optional():
-                    val['optional'] = True
-
-                if len(val) == 1 and 'hash' in val:
-                    file_entries[relative_path] = val['hash']
-                else:
-                    file_entries[relative_path] = val
+                rules.append(rule)
+                paths.append((path, relative_path))
 
             for dirname in dirs:
                 rule, path, relative_path = self.get_rule_and_paths(root,
@@ -162,36 +422,136 @@ class ResourceBuilder(object):
                 if relative_path == OUTPUT_DIRECTORY:
                     dirs.remove(dirname)
 
-        return file_entries
+        file_entries = {}
+        file_entries_without_omissions = {}
+        digests = self.get_hash_binaries(paths)
+        for rule, (path, relative_path), digest in zip(rules, paths, digests):
+            # the Data element in plists is base64-encoded
+            val = {'hash': plistlib.Data(digest)}
+
+            if rule.is_optional():
+                val['optional'] = True
+
+            if len(val) == 1 and 'hash' in val:
+                val = val['hash']
+
+            file_entries[relative_path] = val
+            if not rule.is_omitted():
+                file_entries_without_omissions[relative_path] = val
+
+        return file_entries, file_entries_without_omissions
+
+
+# the parsed template; see get_template
+template = None
 
 
 def get_template():
     """
     Obtain the 'template' plist which also contains things like
-    default rules about which files should count
+    default rules about which files should count.
+    It's only read once, and shared, so copy it before changing it
     """
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    template_path = os.path.join(current_dir, TEMPLATE_FILENAME)
-    fh = open(template_path, 'r')
-    return plistlib.readPlist(fh)
+    global template
+    if template is None:
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        template_path = os.path.join(current_dir, TEMPLATE_FILENAME)
+        with open(template_path, 'r') as fh:
+            template = plistlib.readPlist(fh)
+    return template
+
+
+def get_cache_key(path):
+    """ Identifies a file's contents well enough to cache its digest, without
+        reading it. A file rewritten in place, or a new file at a reused
+        path, gets a new key """
+    st = os.stat(path)
+    return (path, st.st_ino, st.st_size, st.st_mtime)
+
+
+class HashCache(object):
+    """ Digests of files we've hashed, so we don't hash them twice, e.g. when
+        a framework and the app containing it are both sealed. Keyed on
+        get_cache_key, and bounded, least recently used going first.
+        Safe to use from several threads. """
+
+    def __init__(self, max_size=HASH_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # path -> (key, digest). Only the latest digest for a path is
+        # interesting, so we keep one entry per path
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """ the digest for this key, or None """
+        path = key[0]
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is None or entry[0] != key:
+                self.misses += 1
+                return None
+            self.entries[path] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, digest):
+        path = key[0]
+        with self.lock:
+            self.entries.pop(path, None)
+            self.entries[path] = (key, digest)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, path):
+        """ forget the digest for a path, e.g. because we wrote to it """
+        with self.lock:
+            self.entries.pop(path, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+hash_cache = HashCache()
+
+
+def invalidate_hash(path):
+    """ Call this after isign writes a file, so we never reuse an old digest
+        for it, even if the write didn't change its size or mtime """
+    hash_cache.invalidate(path)
+
+
+def get_hash_binary(path):
+    """ Get the hash of a file at path, encoded as binary """
+    key = get_cache_key(path)
+    digest = hash_cache.get(key)
+    if digest is None:
+        hasher = hashlib.sha1()
+        with open(path, 'rb') as afile:
+            buf = afile.read(HASH_BLOCKSIZE)
+            while len(buf) > 0:
+                hasher.update(buf)
+                buf = afile.read(HASH_BLOCKSIZE)
+        digest = hasher.digest()
+        hash_cache.put(key, digest)
+    return digest
 
 
-@memoize
 def get_hash_hex(path):
     """ Get the hash of a file at path, encoded as hexadecimal """
-    hasher = hashlib.sha1()
-    with open(path, 'rb') as afile:
-        buf = afile.read(HASH_BLOCKSIZE)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = afile.read(HASH_BLOCKSIZE)
-    return hasher.hexdigest()
+    return binascii.b2a_hex(get_hash_binary(path))
 
 
-@memoize
-def get_hash_binary(path):
-    """ Get the hash of a file at path, encoded as binary """
-    return binascii.a2b_hex(get_hash_hex(path))
+def hash_file(path):
+    """ get_hash_binary, in a form we can hand to a process pool """
+    return get_hash_binary(path)
 
 
 def write_plist(target_dir, plist):
@@ -202,25 +562,33 @@ def write_plist(target_dir, plist):
     output_path = os.path.join(output_dir, OUTPUT_FILENAME)
     fh = open(output_path, 'w')
     plistlib.writePlist(plist, fh)
+    invalidate_hash(output_path)
     return output_path
 
 
-def make_seal(source_app_path, target_dir=None):
+def make_seal(source_app_path, target_dir=None, hasher=None):
     """
     Given a source app, create a CodeResources file for the
     surrounding directory, and write it into the appropriate path in a target
-    directory
+    directory.
+
+    hasher is a ResourceHasher, which may know some digests already, or
+    let us reuse those in the existing seal.
     """
     if target_dir is None:
         target_dir = os.path.dirname(source_app_path)
+    if hasher is None:
+        hasher = ResourceHasher()
+    prior_seal_path = os.path.join(target_dir, OUTPUT_DIRECTORY, OUTPUT_FILENAME)
+    prior_seal = hasher.get_prior_seal(prior_seal_path)
     template = get_template()
     # n.b. code_resources_template not only contains a template of
     # what the file should look like; it contains default rules
     # deciding which files should be part of the seal
     rules = template['rules2']
     plist = copy.deepcopy(template)
-    resource_builder = ResourceBuilder(source_app_path, rules)
-    plist['files'] = resource_builder.scan()
-    resource_builder2 = ResourceBuilder(source_app_path, rules, True)
-    plist['files2'] = resource_builder2.scan()
+    resource_builder = ResourceBuilder(source_app_path, rules,
+                                       hasher=hasher,
+                                       prior_seal=prior_seal)
+    plist['files'], plist['files2'] = resource_builder.scan()
     return write_plist(target_dir, plist)
@@ -0,0 +1,109 @@
+""" Keeps Signers ready for many credential directories at once, for
+    services that sign for lots of different customers.
+
+    Loading credentials means reading and parsing the key and certs, and
+    checking that the files are all there. The registry does this once per
+    directory, and again only if one of the files changes on disk. """
+
+from exceptions import MissingCredentials
+import isign
+import logging
+import os
+from signer import Credentials, Signer
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def get_files_state(paths):
+    """ Enough about a set of files to tell if any of them changed """
+    state = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            state.append(None)
+            continue
+        state.append((st.st_ino, st.st_size, st.st_mtime))
+    return tuple(state)
+
+
+class RegisteredCredentials(object):
+    """ A handle on one credential directory in the registry: a Signer
+        ready to use, and the provisioning profile to go with it. Pass it
+        to isign.resign as credentials """
+
+    def __init__(self, directory, paths, apple_cert):
+        self.directory = directory
+        self.paths = paths
+        self.provisioning_profile = paths['provisioning_profile']
+        self.files = [paths['key'], paths['certificate'],
+                      self.provisioning_profile, apple_cert]
+        self.state = get_files_state(self.files)
+        if not os.path.exists(self.provisioning_profile):
+            msg = "Can't find {0}".format(self.provisioning_profile)
+            log.warn(msg)
+            raise MissingCredentials(msg)
+        credentials = Credentials.load(paths['key'],
+                                       paths['certificate'],
+                                       apple_cert)
+        self.signer = Signer(credentials=credentials)
+
+    def is_stale(self):
+        return get_files_state(self.files) != self.state
+
+
+class CredentialRegistry(object):
+    """ Loaded credentials by directory. Thread-safe """
+
+    def __init__(self,
+                 apple_cert=isign.DEFAULT_APPLE_CERT_PATH,
+                 file_names=isign.DEFAULT_CREDENTIAL_FILE_NAMES):
+        self.apple_cert = apple_cert
+        self.file_names = file_names
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def _load(self, directory):
+        paths = isign.get_credential_paths(directory, self.file_names)
+        entry = RegisteredCredentials(directory, paths, self.apple_cert)
+        self.entries[directory] = entry
+        log.debug("loaded credentials from %s", directory)
+        return entry
+
+    def load(self, directories):
+        """ Load credentials from all these directories up front. Returns
+            a dict of directory -> exception for any that couldn't be
+            loaded; the rest are ready to use """
+        failures = {}
+        for directory in directories:
+            try:
+                self.get(directory)
+            except Exception as e:
+                log.warn("could not load credentials from %s: %s", directory, e)
+                failures[directory] = e
+        return failures
+
+    def get(self, directory):
+        """ The RegisteredCredentials for this directory, loading them
+            if we haven't yet, or if their files have changed """
+        with self.lock:
+            entry = self.entries.get(directory)
+            if entry is None or entry.is_stale():
+                if entry is not None:
+                    log.debug("credentials in %s changed, reloading", directory)
+                    del self.entries[directory]
+                entry = self._load(directory)
+            return entry
+
+    def forget(self, directory):
+        with self.lock:
+            self.entries.pop(directory, None)
+
+    def __contains__(self, directory):
+        with self.lock:
+            return directory in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
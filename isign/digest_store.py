@@ -0,0 +1,158 @@
+""" A persistent store of file digests, shared between signing jobs.
+
+    If you resign the same app builds over and over, most of their resources
+    are byte-identical every time, and there's no need to hash them again.
+    The store maps a cheap fingerprint of a file to its SHA-1 digest.
+
+    A fingerprint is the file's size, the CRC32 of its whole contents, and a
+    hash of a few blocks sampled from it. We never compute the CRC ourselves,
+    that would cost about as much as the SHA-1. Instead we get it for free
+    from the zip archive the file was extracted from, so only files that came
+    out of an archive, and haven't changed since, are looked up at all.
+
+    A file whose fingerprint is in the store is never hashed, so nothing
+    checks the stored digest against it. An accidental collision needs the
+    same size, the same CRC32 and the same sampled blocks, but CRC32 is no
+    defense against someone crafting one, so don't share a store with
+    people you don't trust. If two jobs that both missed store different
+    digests for one fingerprint, we stop using that fingerprint.
+
+    Several jobs can share a store. Each write is committed straight away,
+    and if the database is busy for longer than BUSY_TIMEOUT, we treat that
+    as a miss, or skip the write, rather than wait. """
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+# blocks of this size are sampled from the start, middle and end of files
+SAMPLE_SIZE = 4096
+# smaller files are quicker to hash than to look up
+MIN_SIZE = 256 * 1024
+DEFAULT_MAX_ENTRIES = 100000
+# seconds to wait for another job to finish writing
+BUSY_TIMEOUT = 1.0
+
+log = logging.getLogger(__name__)
+
+
+def get_fingerprint(path, size, crc):
+    """ Fingerprint of a file, given its size and CRC32 """
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for offset in (0, (size - SAMPLE_SIZE) // 2, size - SAMPLE_SIZE):
+            fh.seek(max(offset, 0))
+            hasher.update(fh.read(SAMPLE_SIZE))
+    return '{0}-{1:08x}-{2}'.format(size, crc & 0xffffffff, hasher.hexdigest())
+
+
+class DigestStore(object):
+    """ Digests by fingerprint, in an sqlite database. Keeps at most
+        max_entries of the most recently used ones; the rest are
+        pruned when the store is closed """
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT,
+                                  check_same_thread=False)
+        self.db.text_factory = str
+        try:
+            # lets readers carry on while another job writes
+            self.db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.OperationalError as e:
+            log.debug("digest store %s can't use WAL: %s", path, e)
+        self.db.execute('CREATE TABLE IF NOT EXISTS digests ('
+                        'fingerprint TEXT PRIMARY KEY, '
+                        'digest BLOB, '
+                        'collided INTEGER NOT NULL DEFAULT 0, '
+                        'last_used REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS digests_last_used '
+                        'ON digests (last_used)')
+        self.db.commit()
+
+    def get(self, fingerprint):
+        """ the digest for this fingerprint, or None """
+        with self.lock:
+            try:
+                row = self.db.execute('SELECT digest, collided FROM digests '
+                                      'WHERE fingerprint = ?',
+                                      (fingerprint,)).fetchone()
+            except sqlite3.OperationalError as e:
+                log.debug("digest store %s: %s", self.path, e)
+                row = None
+            if row is None or row[1]:
+                self.misses += 1
+                return None
+            self._write('UPDATE digests SET last_used = ? '
+                        'WHERE fingerprint = ?',
+                        (time.time(), fingerprint))
+            self.hits += 1
+            return str(row[0])
+
+    def put(self, fingerprint, digest):
+        with self.lock:
+            try:
+                row = self.db.execute('SELECT digest FROM digests '
+                                      'WHERE fingerprint = ?',
+                                      (fingerprint,)).fetchone()
+            except sqlite3.OperationalError as e:
+                log.debug("digest store %s: %s", self.path, e)
+                return
+            if row is None:
+                # if another job put it first, that's fine
+                self._write('INSERT OR IGNORE INTO digests '
+                            '(fingerprint, digest, last_used) '
+                            'VALUES (?, ?, ?)',
+                            (fingerprint, sqlite3.Binary(digest),
+                             time.time()))
+            elif row[0] is not None and str(row[0]) != digest:
+                log.warning("digest store collision for %s", fingerprint)
+                self._write('UPDATE digests '
+                            'SET digest = NULL, collided = 1 '
+                            'WHERE fingerprint = ?',
+                            (fingerprint,))
+
+    def _write(self, sql, parameters):
+        """ Run and commit one write. If the database stays busy, skip it;
+            the store is only a cache. Call with the lock held """
+        try:
+            self.db.execute(sql, parameters)
+            self.db.commit()
+        except sqlite3.OperationalError as e:
+            log.debug("digest store %s: skipped write: %s", self.path, e)
+            self.db.rollback()
+
+    def prune(self, max_entries=None):
+        """ Forget all but the max_entries most recently used digests.
+            Returns how many were forgotten """
+        if max_entries is None:
+            max_entries = self.max_entries
+        with self.lock:
+            try:
+                cursor = self.db.execute('DELETE FROM digests WHERE fingerprint IN '
+                                         '(SELECT fingerprint FROM digests '
+                                         'ORDER BY last_used DESC '
+                                         'LIMIT -1 OFFSET ?)',
+                                         (max_entries,))
+                self.db.commit()
+            except sqlite3.OperationalError as e:
+                log.debug("digest store %s: skipped pruning: %s", self.path, e)
+                self.db.rollback()
+                return 0
+        return cursor.rowcount
+
+    def close(self):
+        pruned = self.prune()
+        log.debug("digest store %s: %d hits, %d misses, %d pruned",
+                  self.path, self.hits, self.misses, pruned)
+        self.db.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM digests').fetchone()[0]
@@ -52,9 +52,15 @@ else:
 
 def resign_with_creds_dir(input_path,
                           credentials_directory,
+                          registry=None,
                           **kwargs):
-    """ Do isign.resign(), but with credential files from this directory """
-    kwargs.update(get_credential_paths(credentials_directory))
+    """ Do isign.resign(), but with credential files from this directory.
+        If registry is a credential_registry.CredentialRegistry, the
+        credentials come from there, already loaded """
+    if registry is not None:
+        kwargs['credentials'] = registry.get(credentials_directory)
+    else:
+        kwargs.update(get_credential_paths(credentials_directory))
     return resign(input_path, **kwargs)
 
 
@@ -66,9 +72,19 @@ def resign(input_path,
            provisioning_profile=DEFAULT_CREDENTIAL_PATHS['provisioning_profile'],
            output_path=join(os.getcwd(), "out"),
            info_props=None,
-           alternate_entitlements_path=None):
+           alternate_entitlements_path=None,
+           hash_workers=1,
+           digest_store_path=None,
+           credentials=None):
     """ Mirrors archive.resign(), put here for convenience, to unify exceptions,
-        and to omit default args """
+        and to omit default args.
+        credentials, if given, is a handle from a
+        credential_registry.CredentialRegistry, used instead of
+        apple_cert, certificate, key and provisioning_profile """
+    signer = None
+    if credentials is not None:
+        signer = credentials.signer
+        provisioning_profile = credentials.provisioning_profile
     try:
         return archive.resign(input_path,
                               deep,
@@ -78,13 +94,55 @@ def resign(input_path,
                               provisioning_profile,
                               output_path,
                               info_props,
-                              alternate_entitlements_path)
+                              alternate_entitlements_path,
+                              hash_workers,
+                              digest_store_path,
+                              signer)
     except exceptions.NotSignable as e:
         # re-raise the exception without exposing internal
         # details of how it happened
         raise NotSignable(e)
 
 
+def resign_many(input_paths,
+                output_paths,
+                deep=True,
+                apple_cert=DEFAULT_APPLE_CERT_PATH,
+                certificate=DEFAULT_CREDENTIAL_PATHS['certificate'],
+                key=DEFAULT_CREDENTIAL_PATHS['key'],
+                provisioning_profile=DEFAULT_CREDENTIAL_PATHS['provisioning_profile'],
+                info_props=None,
+                alternate_entitlements_path=None,
+                hash_workers=1,
+                digest_store_path=None,
+                credentials=None):
+    """ Mirrors archive.resign_many(): resign many apps with the same
+        credentials, pipelining unarchiving, signing and archiving.
+        Returns a list of (input path, output path, error or None) """
+    signer = None
+    if credentials is not None:
+        signer = credentials.signer
+        provisioning_profile = credentials.provisioning_profile
+    results = archive.resign_many(input_paths,
+                                  output_paths,
+                                  deep,
+                                  certificate,
+                                  key,
+                                  apple_cert,
+                                  provisioning_profile,
+                                  info_props,
+                                  alternate_entitlements_path,
+                                  hash_workers,
+                                  digest_store_path,
+                                  signer)
+    unified = []
+    for input_path, output_path, error in results:
+        if isinstance(error, exceptions.NotSignable):
+            error = NotSignable(error)
+        unified.append((input_path, output_path, error))
+    return unified
+
+
 def view(input_path):
     """ Obtain information about the app """
     try:
@@ -11,13 +11,21 @@ import construct
 import hashlib
 import logging
 import math
+import mmap
 import macho
 import macho_cs
+import time
 import utils
 
 
 log = logging.getLogger(__name__)
 
+PAGE_SIZE = 0x1000
+# threads to hash pages with. hashlib releases the GIL for each page
+HASH_WORKERS = 4
+# below this many pages, threads aren't worth starting
+PARALLEL_MIN_PAGES = 1024
+
 
 def make_arg(data_type, arg):
     if data_type.name == 'Data':
@@ -220,6 +228,67 @@ def make_basic_codesig(entitlements_file, drs, code_limit, hashes, signer, ident
     return macho_cs.Blob.parse(chunk)
 
 
+def hash_page_range(mm, file_size, arch_offset, header_data, code_limit,
+                    first_page, end_page):
+    """ SHA-1 of pages first_page up to end_page of a slice; see hash_pages """
+    header_length = len(header_data)
+    hashes = []
+    for i in xrange(first_page, end_page):
+        start = PAGE_SIZE * i
+        end = min(start + PAGE_SIZE, code_limit)
+        hasher = hashlib.sha1()
+        # the rebuilt header, then whatever follows it in the file
+        header_part = header_data[start:end]
+        hasher.update(header_part)
+        file_start = min(arch_offset + max(start, header_length), file_size)
+        file_end = min(arch_offset + end, file_size)
+        file_length = max(file_end - file_start, 0)
+        hasher.update(buffer(mm, file_start, file_length))
+        missing = (end - start) - len(header_part) - file_length
+        if missing > 0:
+            hasher.update("\x00" * missing)
+        hashes.append(hasher.digest())
+    return hashes
+
+
+def hash_pages(f, arch_offset, header_data, code_limit, workers=None):
+    """ SHA-1 of each page of a slice, as it will be once header_data is
+        written over its start, up to code_limit. Past the end of the file
+        the slice is taken to be zeros.
+
+        The file is memory-mapped, and pages are hashed straight out of the
+        map, so we never hold a copy of the slice. Big slices are split into
+        runs of pages, hashed on this many threads at once """
+    if workers is None:
+        workers = HASH_WORKERS
+    f.seek(0, 2)
+    file_size = f.tell()
+    n_pages = int(math.ceil(float(code_limit) / PAGE_SIZE))
+    start_time = time.time()
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if workers <= 1 or n_pages < PARALLEL_MIN_PAGES:
+            hashes = hash_page_range(mm, file_size, arch_offset, header_data,
+                                     code_limit, 0, n_pages)
+        else:
+            run_length = int(math.ceil(float(n_pages) / workers))
+            runs = utils.map_threaded(lambda first: hash_page_range(mm, file_size,
+                                                                    arch_offset,
+                                                                    header_data,
+                                                                    code_limit,
+                                                                    first,
+                                                                    min(first + run_length,
+                                                                        n_pages)),
+                                      range(0, n_pages, run_length))
+            hashes = [page_hash for run in runs for page_hash in run]
+    finally:
+        mm.close()
+    elapsed = time.time() - start_time
+    if elapsed > 0:
+        log.debug("hashed {} pages at {:.0f} pages/sec".format(n_pages, n_pages / elapsed))
+    return hashes
+
+
 def make_signature(arch_macho, arch_offset, arch_size, cmds, f, entitlements_file, codesig_data_length, signer, ident):
     # NB: arch_offset is absolute in terms of file start.  Everything else is relative to arch_offset!
 
@@ -252,6 +321,10 @@ def make_signature(arch_macho, arch_offset, arch_size, cmds, f, entitlements_fil
             ident)
     codesig_data = macho_cs.Blob.build(codesig_cons)
 
+    if codesig_data_length is None:
+        # reserve room for the signature; see Signer.get_signature_size
+        codesig_data_length = len(codesig_data) + signer.get_signature_size()
+
     cmd_data = construct.Container(dataoff=codesig_offset,
             datasize=codesig_data_length)
     cmd = construct.Container(cmd='LC_CODE_SIGNATURE',
@@ -295,24 +368,13 @@ def make_signature(arch_macho, arch_offset, arch_size, cmds, f, entitlements_fil
                     log.debug("new filesize {}, vmsize {}".format(lc.data.filesize, lc.data.vmsize))
 
 
-        actual_data = macho.MachO.build(arch_macho)
-        log.debug("actual_data length with codesig LC {}".format(len(actual_data)))
-
-        # Now seek to the start of the actual data and read until the end of the arch.
-        f.seek(arch_offset + len(actual_data))
-        bytes_to_read = codesig_offset + arch_offset - f.tell()
-        file_slice = f.read(bytes_to_read)
-        if len(file_slice) < bytes_to_read:
-            log.warn("expected {} bytes but got {}, zero padding.".format(bytes_to_read, len(file_slice)))
-            file_slice += ("\x00" * (bytes_to_read - len(file_slice)))
-        actual_data += file_slice
+        header_data = macho.MachO.build(arch_macho)
+        log.debug("header length with codesig LC {}".format(len(header_data)))
 
-        for i in xrange(nCodeSlots):
-            actual_data_slice = actual_data[(0x1000 * i):(0x1000 * i + 0x1000)]
-
-            actual = hashlib.sha1(actual_data_slice).digest()
+        # Hash the pages of the slice, with the new header in place
+        hashes = hash_pages(f, arch_offset, header_data, codesig_offset)
+        for i, actual in enumerate(hashes):
             log.debug("Slot {} (File page @{}): {}".format(i, hex(0x1000 * i), actual.encode('hex')))
-            hashes.append(actual)
     else:
         hashes = fake_hashes
 
@@ -324,8 +386,9 @@ def make_signature(arch_macho, arch_offset, arch_size, cmds, f, entitlements_fil
             signer,
             ident)
     codesig_data = macho_cs.Blob.build(codesig_cons)
+    # datasize is the space we reserved, which the signature will fill
     cmd_data = construct.Container(dataoff=codesig_offset,
-            datasize=len(codesig_data))
+            datasize=codesig_data_length)
     cmd = construct.Container(cmd='LC_CODE_SIGNATURE',
             cmdsize=16,
             data=cmd_data,
@@ -1,36 +1,127 @@
 from os.path import isdir
 import isign
 from archive import archive_factory
-from signer import Signer
+import code_resources
+from credential_registry import CredentialRegistry
 import logging
 import multiprocessing
+import pickle
+import time
 
 log = logging.getLogger(__name__)
 
 MAX_PROCESSES = multiprocessing.cpu_count()
 
-
-def resign(args):
+# Credentials loaded in this process, by directory. In a SigningPool's
+# workers, these are loaded before any work arrives
+registry = CredentialRegistry()
+
+
+def warm_up_worker(cred_dirs):
+    """ Get a new worker process ready to sign: load the seal template,
+        and credentials from these directories """
+    code_resources.get_template()
+    if cred_dirs:
+        registry.load(cred_dirs)
+
+
+def resign_in_worker(args):
+    """ isign.resign, or with a credentials directory,
+        isign.resign_with_creds_dir, using this process's registry """
+    input_path, credentials_directory, kwargs = args
+    if credentials_directory is None:
+        return isign.resign(input_path, **kwargs)
+    return isign.resign_with_creds_dir(input_path, credentials_directory,
+                                       registry=registry, **kwargs)
+
+
+class SigningPool(object):
+    """ Worker processes for multisign, or for resigning many apps. Make one
+        and pass it to as many calls as you like, then close it, or use it
+        as a context manager.
+
+        Workers load the credentials in cred_dirs as they start, and keep
+        whatever credentials they load for the next job. If maxtasksperchild
+        is given, each worker is replaced after that many jobs. """
+
+    def __init__(self, processes=MAX_PROCESSES, cred_dirs=None,
+                 maxtasksperchild=None):
+        self.pool = multiprocessing.Pool(processes,
+                                         initializer=warm_up_worker,
+                                         initargs=(cred_dirs,),
+                                         maxtasksperchild=maxtasksperchild)
+        self.closed = False
+
+    def map(self, func, iterable):
+        return self.pool.map(func, iterable)
+
+    def imap_unordered(self, func, iterable):
+        return self.pool.imap_unordered(func, iterable)
+
+    def resign(self, input_path, **kwargs):
+        """ isign.resign, in a worker. Returns at once, with a
+            multiprocessing AsyncResult; its get() returns what
+            isign.resign did, or raises what it raised """
+        return self.pool.apply_async(resign_in_worker,
+                                     ((input_path, None, kwargs),))
+
+    def resign_with_creds_dir(self, input_path, credentials_directory, **kwargs):
+        """ isign.resign_with_creds_dir, in a worker, with credentials it
+            has already loaded if it can. Returns an AsyncResult, as
+            resign does """
+        return self.pool.apply_async(resign_in_worker,
+                                     ((input_path, credentials_directory, kwargs),))
+
+    def close(self):
+        """ Finish any work in progress, then stop the workers """
+        if not self.closed:
+            self.closed = True
+            self.pool.close()
+            self.pool.join()
+
+    def terminate(self):
+        """ Stop the workers now """
+        if not self.closed:
+            self.closed = True
+            self.pool.terminate()
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+def resign(args, timings=None):
     """ Given a tuple consisting of a path to an uncompressed archive,
         credential directory, and desired output path, resign accordingly.
+        If timings is a dict, the seconds spent signing and archiving are
+        added to it.
 
         Returns a tuple of (cred_dir, path to resigned app) """
     ua, cred_dir, resigned_path = args
+    if timings is None:
+        timings = {}
 
     try:
         log.debug('resigning with %s %s -> %s', ua.path, cred_dir, resigned_path)
-        # get the credential files, create the 'signer'
-        credential_paths = isign.get_credential_paths(cred_dir)
-        signer = Signer(signer_cert_file=credential_paths['certificate'],
-                        signer_key_file=credential_paths['key'],
-                        apple_cert_file=isign.DEFAULT_APPLE_CERT_PATH)
+        start = time.time()
+        # get the credentials, which this process may have loaded already
+        credentials = registry.get(cred_dir)
 
         # sign it (in place)
-        ua.bundle.resign(signer, credential_paths['provisioning_profile'])
+        ua.bundle.resign(True, credentials.signer, credentials.provisioning_profile)
+        timings['sign'] = time.time() - start
 
         log.debug("outputing %s", resigned_path)
         # and archive it there
+        start = time.time()
         ua.archive(resigned_path)
+        timings['archive'] = time.time() - start
 
     finally:
         ua.remove()
@@ -38,6 +129,32 @@ def resign(args):
     return (cred_dir, resigned_path)
 
 
+def get_picklable_error(e):
+    """ The exception, or if it can't be sent back from a worker
+        process, one that can """
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return Exception("{0}: {1}".format(e.__class__.__name__, e))
+
+
+def resign_and_report(args):
+    """ Like resign, but never raises. Returns a tuple of
+        (cred_dir, path to resigned app, error or None, timings) """
+    _, cred_dir, resigned_path = args
+    timings = {}
+    error = None
+    start = time.time()
+    try:
+        resign(args, timings)
+    except Exception as e:
+        log.exception("resigning with %s failed", cred_dir)
+        error = get_picklable_error(e)
+    timings['total'] = time.time() - start
+    return (cred_dir, resigned_path, error, timings)
+
+
 def clone_ua(args):
     original_ua, target_ua_path = args
     log.debug('cloning %s to %s', original_ua.path, target_ua_path)
@@ -46,10 +163,12 @@ def clone_ua(args):
     return ua
 
 
-def multisign(original_path, cred_dirs_to_output_paths, info_props=None):
+def multisign(original_path, cred_dirs_to_output_paths, info_props=None,
+              pool=None):
     """ Given a path to an app,
         a mapping of credential directories to desired output paths,
         optional info.plist properties to overwrite,
+        and optionally a SigningPool to work in,
 
         produce re-signed versions of the app as desired.
 
@@ -63,29 +182,72 @@ def multisign(original_path, cred_dirs_to_output_paths, info_props=None):
         log.debug("%s didn't look like an app...", original_path)
         return None
 
-    return multisign_archive(archive, cred_dirs_to_output_paths, info_props)
+    return multisign_archive(archive, cred_dirs_to_output_paths, info_props, pool)
+
+
+def multisign_iter(original_path, cred_dirs_to_output_paths, info_props=None,
+                   pool=None):
+    """ Like multisign, but yields results as each one is ready.
+        See: multisign_archive_iter, which this wraps. """
+
+    archive = archive_factory(original_path)
+    if archive is None:
+        log.debug("%s didn't look like an app...", original_path)
+        return iter([])
+
+    return multisign_archive_iter(archive, cred_dirs_to_output_paths, info_props,
+                                  pool)
 
 
-def multisign_archive(archive, cred_dirs_to_output_paths, info_props=None):
+def multisign_archive(archive, cred_dirs_to_output_paths, info_props=None,
+                      pool=None):
     """ Given an isign.archive object,
         a mapping of credential directories to desired output paths,
         optional info.plist properties to overwrite,
+        and optionally a SigningPool to work in (otherwise we make one),
 
         produce re-signed versions of the IPA.
 
         If info_props are provided, it will overwrite those properties in
         the app's Info.plist.
 
+        If any resigning fails, the first error is raised, once the
+        others are done.
+
         Returns an array of tuples of [(credentials_dir, resigned app path)...]
     """
+    results = {}
+    errors = []
+    for cred_dir, output_path, error, _ in multisign_archive_iter(
+            archive, cred_dirs_to_output_paths, info_props, pool):
+        results[cred_dir] = (cred_dir, output_path)
+        if error is not None:
+            errors.append(error)
+    if errors:
+        raise errors[0]
+    return [results[cred_dir] for cred_dir in cred_dirs_to_output_paths]
+
+
+def multisign_archive_iter(archive, cred_dirs_to_output_paths, info_props=None,
+                           pool=None):
+    """ Like multisign_archive, but a generator of results, in the order
+        the resignings finish. Each is a tuple of
+        (credentials_dir, resigned app path, error, timings)
+
+        error is None if that resigning succeeded, or else the exception.
+        One failing doesn't affect the others.
+        timings is a dict of seconds spent: 'sign', 'archive' and 'total' """
 
     # get ready for multiple processes...
-    p = multiprocessing.Pool(MAX_PROCESSES)
+    own_pool = pool is None
+    if own_pool:
+        pool = SigningPool()
 
     # ua is potentially an isign.archive.UncompressedArchive
     ua = None
-
-    results = []
+    uas = []
+    results = iter([])
+    finished = False
 
     try:
         ua = archive.unarchive_to_temp()
@@ -93,6 +255,9 @@ def multisign_archive(archive, cred_dirs_to_output_paths, info_props=None):
             # Override info.plist props
             ua.bundle.update_info_props(info_props)
 
+        # The resources are the same in every copy, so hash them just once
+        ua.hash_resources()
+
         # Since the signing process rewrites files, we must first create uncompressed archives
         # for each credentials_directory.
         # The first is simply the uncompressed archive we just made
@@ -104,7 +269,7 @@ def multisign_archive(archive, cred_dirs_to_output_paths, info_props=None):
         target_ua_paths = []
         for i in range(1, len(cred_dirs_to_output_paths)):
             target_ua_paths.append((ua, ua.path + '_' + str(i)))
-        uas += p.map(clone_ua, target_ua_paths)
+        uas += pool.map(clone_ua, target_ua_paths)
 
         # now we should have one UncompressedArchive for every credential directory
         assert len(uas) == len(cred_dirs_to_output_paths)
@@ -117,7 +282,10 @@ def multisign_archive(archive, cred_dirs_to_output_paths, info_props=None):
 
         # In parallel, resign each uncompressed archive with supplied credentials,
         # and make archives in the desired paths.
-        results = p.map(resign, resign_args)
+        results = pool.imap_unordered(resign_and_report, resign_args)
+        for result in results:
+            yield result
+        finished = True
 
     except isign.NotSignable as e:
         msg = "Not signable: <{0}>: {1}\n".format(archive.path, e)
@@ -125,7 +293,17 @@ def multisign_archive(archive, cred_dirs_to_output_paths, info_props=None):
         raise
 
     finally:
-        if ua is not None and isdir(ua.path):
-            ua.remove()
-
-    return results
+        if own_pool:
+            # if we stopped early, don't wait for the rest
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+        elif not finished:
+            # the pool isn't ours to stop, so let the workers finish
+            # with our copies before we remove them
+            for _ in results:
+                pass
+        for each_ua in uas + [ua]:
+            if each_ua is not None and isdir(each_ua.path):
+                each_ua.remove()
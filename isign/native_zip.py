@@ -0,0 +1,371 @@
+""" Extracts and writes zip archives (IPAs, zipped apps) inside the
+    Python process, instead of forking the external zip and unzip helpers.
+
+    Doing this ourselves means we can see each member of an archive
+    as we go, which lets us skip work on a per-member basis. """
+
+import hashlib
+import logging
+import os
+from os.path import (basename, dirname, isdir, join, lexists, normpath,
+                     relpath, splitext)
+import shutil
+import stat
+import struct
+import time
+import zipfile
+
+COPY_BLOCKSIZE = 65536
+# zip64 extra field id. We strip these when copying members, the zipfile
+# module adds them back if it needs them.
+ZIP64_EXTRA_ID = 0x0001
+# general purpose flag bit meaning sizes and CRC follow the data
+DATA_DESCRIPTOR_FLAG = 0x08
+
+# When extracting selectively, we only write out files that isign
+# might read or rewrite: Mach-O binaries (thin or fat, either byte order),
+# plus these by name.
+MACHO_MAGICS = ['\xce\xfa\xed\xfe', '\xcf\xfa\xed\xfe',
+                '\xfe\xed\xfa\xce', '\xfe\xed\xfa\xcf',
+                '\xca\xfe\xba\xbe', '\xbe\xba\xfe\xca']
+SELECTIVE_NAMES = ['Info.plist', 'CodeResources']
+SELECTIVE_EXTENSIONS = ['.mobileprovision']
+
+log = logging.getLogger(__name__)
+
+
+def is_safe_member_name(name):
+    """ Refuse absolute paths and paths that climb out of the
+        target directory, as unzip does """
+    if name.startswith('/') or name.startswith('\\'):
+        return False
+    parts = name.replace('\\', '/').split('/')
+    return '..' not in parts
+
+
+def get_member_mode(info):
+    """ Unix permission bits stored in a zip member, if any """
+    return info.external_attr >> 16
+
+
+def get_member_mtime(info):
+    """ Modification time of a zip member as a timestamp. Zip stores
+        local time, as does unzip when restoring it """
+    return time.mktime(info.date_time + (0, 0, -1))
+
+
+def is_wanted_on_disk(name, first_block):
+    """ When extracting selectively, should this member be written out? """
+    if basename(name) in SELECTIVE_NAMES:
+        return True
+    if splitext(name)[1] in SELECTIVE_EXTENSIONS:
+        return True
+    return first_block[:4] in MACHO_MAGICS
+
+
+def restore_attributes(path, info):
+    """ Give an extracted file or directory the permissions and
+        modification time stored in its zip member """
+    mode = get_member_mode(info)
+    if mode:
+        os.chmod(path, stat.S_IMODE(mode))
+    mtime = get_member_mtime(info)
+    os.utime(path, (mtime, mtime))
+
+
+def extract_member(zipfile_obj, info, target_dir, zip_source, selective=False):
+    """ Write one member of the archive into target_dir, restoring its
+        permissions and modification time, and record it in zip_source.
+        Directories are only created; extract restores their attributes
+        once everything in them is written.
+
+        If selective, ordinary resources aren't written; instead we
+        record their SHA-1 digest as computed from the archive """
+    name = info.filename
+    if not is_safe_member_name(name):
+        log.warning("skipping unsafe zip member: %s", name)
+        return
+    path = normpath(join(target_dir, name))
+    mode = get_member_mode(info)
+
+    if name.endswith('/'):
+        if not isdir(path):
+            os.makedirs(path)
+        zip_source.record(name, path)
+        return
+
+    parent = dirname(path)
+    if not isdir(parent):
+        os.makedirs(parent)
+
+    if stat.S_ISLNK(mode):
+        os.symlink(zipfile_obj.read(info), path)
+        zip_source.record(name, path)
+        return
+
+    source = zipfile_obj.open(info)
+    try:
+        first_block = source.read(COPY_BLOCKSIZE)
+        if selective and not is_wanted_on_disk(name, first_block):
+            hasher = hashlib.sha1(first_block)
+            buf = source.read(COPY_BLOCKSIZE)
+            while len(buf) > 0:
+                hasher.update(buf)
+                buf = source.read(COPY_BLOCKSIZE)
+            zip_source.record_unextracted(name, hasher.digest())
+            return
+        with open(path, 'wb') as dest:
+            dest.write(first_block)
+            shutil.copyfileobj(source, dest, COPY_BLOCKSIZE)
+    finally:
+        source.close()
+    restore_attributes(path, info)
+    zip_source.record(name, path, info.CRC)
+
+
+def get_path_state(path):
+    """ Enough about a path on disk to tell if it changed since we
+        wrote it """
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        return ('link', os.readlink(path))
+    if stat.S_ISDIR(st.st_mode):
+        return ('dir',)
+    return ('file', st.st_size, st.st_mtime)
+
+
+class ZipSource(object):
+    """ Remembers the archive a directory was extracted from, and the state
+        of every member we wrote, so when we archive the directory again we
+        can copy unchanged members straight from the source archive.
+
+        After a selective extraction, also remembers the digests of members
+        we left in the archive. """
+
+    def __init__(self, path):
+        self.path = path
+        self.members = {}
+        self.unextracted = {}
+        self.checksums = {}
+
+    def record(self, name, path, crc=None):
+        self.members[name] = get_path_state(path)
+        if crc is not None:
+            self.checksums[name] = crc
+
+    def record_unextracted(self, name, digest):
+        self.unextracted[name] = digest
+
+    def is_unchanged(self, name, path):
+        return (name in self.members and
+                lexists(path) and
+                get_path_state(path) == self.members[name])
+
+    def is_virtual(self, name, path):
+        """ Is this a member we never extracted, that nobody has since
+            written to disk, or deleted along with its directory? """
+        return (name in self.unextracted and
+                not lexists(path) and
+                isdir(dirname(path)))
+
+    def get_virtual_files(self, containing_dir):
+        """ Map of path -> SHA-1 digest of the files that would be in
+            containing_dir, had we extracted everything """
+        virtual_files = {}
+        for name, digest in self.unextracted.iteritems():
+            path = normpath(join(containing_dir, name))
+            if self.is_virtual(name, path):
+                virtual_files[path] = digest
+        return virtual_files
+
+    def get_checksums(self, containing_dir):
+        """ Map of path -> ((size, mtime), CRC32) of the files we extracted
+            into containing_dir, as they were when we extracted them """
+        checksums = {}
+        for name, crc in self.checksums.iteritems():
+            state = self.members[name]
+            path = normpath(join(containing_dir, name))
+            checksums[path] = (state[1:], crc)
+        return checksums
+
+
+def extract(zip_path, target_dir, selective=False):
+    """ Extract an archive into target_dir. Returns a ZipSource
+        describing what was extracted.
+
+        If selective, only extract what isign needs on disk; see
+        is_wanted_on_disk. Everything else is hashed as it streams out of
+        the archive, and can be copied back from it when repacking """
+    log.debug("extracting %s to %s%s", zip_path, target_dir,
+              " selectively" if selective else "")
+    zip_source = ZipSource(zip_path)
+    zipfile_obj = zipfile.ZipFile(zip_path)
+    directories = []
+    try:
+        for info in zipfile_obj.infolist():
+            extract_member(zipfile_obj, info, target_dir, zip_source, selective)
+            if info.filename.endswith('/') and is_safe_member_name(info.filename):
+                directories.append((normpath(join(target_dir, info.filename)), info))
+    finally:
+        zipfile_obj.close()
+    # as unzip does, once their contents are written, deepest first, since
+    # writing into a directory changes its mtime
+    for path, info in sorted(directories, reverse=True):
+        restore_attributes(path, info)
+    if selective:
+        log.debug("extracted %d members, left %d in the archive",
+                  len(zip_source.members), len(zip_source.unextracted))
+    return zip_source
+
+
+def walk_tree(source_dir, followlinks=True):
+    """ Yield (path, archive name) for everything under source_dir, in a
+        stable order. Directories get a trailing slash, as with zip -r.
+        Like zip -r, we follow symlinks by default """
+    for root, dirs, filenames in os.walk(source_dir, followlinks=followlinks):
+        dirs.sort()
+        if root != source_dir:
+            yield root, relpath(root, source_dir) + '/'
+        for filename in sorted(filenames):
+            path = join(root, filename)
+            yield path, relpath(path, source_dir)
+
+
+def write_tree(source_dir, output_path):
+    """ Deflate everything under source_dir into a new archive at
+        output_path, with names relative to source_dir """
+    log.debug("writing %s to %s", source_dir, output_path)
+    zipfile_obj = zipfile.ZipFile(output_path, 'w',
+                                  zipfile.ZIP_DEFLATED,
+                                  allowZip64=True)
+    try:
+        for path, name in walk_tree(source_dir):
+            zipfile_obj.write(path, name)
+    finally:
+        zipfile_obj.close()
+
+
+def strip_zip64_extra(extra):
+    """ Remove any zip64 field from a member's extra data """
+    stripped = ''
+    while len(extra) >= 4:
+        header_id, size = struct.unpack('<HH', extra[:4])
+        if header_id != ZIP64_EXTRA_ID:
+            stripped += extra[:4 + size]
+        extra = extra[4 + size:]
+    return stripped
+
+
+def get_copied_info(info):
+    """ A fresh ZipInfo for writing a member like info into another
+        archive """
+    new_info = zipfile.ZipInfo(info.filename, info.date_time)
+    for attr in ('compress_type', 'comment', 'create_system',
+                 'create_version', 'extract_version', 'reserved',
+                 'volume', 'internal_attr', 'external_attr',
+                 'CRC', 'compress_size', 'file_size'):
+        setattr(new_info, attr, getattr(info, attr))
+    # sizes and CRC go in the local header, so no data descriptor follows
+    new_info.flag_bits = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+    new_info.extra = strip_zip64_extra(info.extra)
+    return new_info
+
+
+def copy_member_raw(source_zipfile_obj, info, zipfile_obj):
+    """ Copy a member's compressed bytes from one archive into another,
+        rebuilding only the local header. Nothing is inflated or deflated.
+
+        This uses zipfile internals (_FH_* offsets, _writecheck,
+        _didModify), as checked against the zipfile module of Python
+        2.7.8 to 2.7.18. They're all looked up before anything is written,
+        so if one is missing we raise AttributeError with the output
+        archive untouched """
+    source_fp = source_zipfile_obj.fp
+    source_fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           source_fp.read(zipfile.sizeFileHeader))
+    source_fp.seek(header[zipfile._FH_FILENAME_LENGTH] +
+                   header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    new_info = get_copied_info(info)
+    new_info.header_offset = zipfile_obj.fp.tell()
+
+    zipfile_obj._writecheck(new_info)
+    zipfile_obj._didModify = True
+    zipfile_obj.fp.write(new_info.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        buf = source_fp.read(min(COPY_BLOCKSIZE, remaining))
+        if not buf:
+            raise zipfile.BadZipfile("truncated member: {}".format(info.filename))
+        zipfile_obj.fp.write(buf)
+        remaining -= len(buf)
+    zipfile_obj.filelist.append(new_info)
+    zipfile_obj.NameToInfo[new_info.filename] = new_info
+
+
+def copy_member(source_zipfile_obj, info, zipfile_obj):
+    """ Copy a member from one archive into another, as raw compressed
+        bytes if this zipfile module lets us, or else by inflating and
+        deflating it again """
+    try:
+        copy_member_raw(source_zipfile_obj, info, zipfile_obj)
+    except AttributeError as e:
+        log.debug("can't copy %s raw, recompressing: %s", info.filename, e)
+        zipfile_obj.writestr(get_copied_info(info),
+                             source_zipfile_obj.read(info))
+
+
+def get_parent_names(name):
+    """ archive names of the directories containing this member """
+    parts = name.rstrip('/').split('/')[:-1]
+    return ['/'.join(parts[:i]) + '/' for i in range(1, len(parts) + 1)]
+
+
+def repack(source_dir, output_path, zip_source):
+    """ Like write_tree, but members that are unchanged since they were
+        extracted from zip_source, or that were never extracted at all, are
+        copied across as raw compressed bytes. Members that were deleted are
+        dropped, and new files are deflated as usual """
+    log.debug("repacking %s to %s, from %s",
+              source_dir, output_path, zip_source.path)
+    source_zipfile_obj = zipfile.ZipFile(zip_source.path)
+    zipfile_obj = zipfile.ZipFile(output_path, 'w',
+                                  zipfile.ZIP_DEFLATED,
+                                  allowZip64=True)
+    seen = set()
+    copied = 0
+    written = 0
+    try:
+        for info in source_zipfile_obj.infolist():
+            name = info.filename
+            path = normpath(join(source_dir, name))
+            if zip_source.is_virtual(name, path):
+                copy_member(source_zipfile_obj, info, zipfile_obj)
+                seen.add(name)
+                copied += 1
+                continue
+            if name not in zip_source.members and name not in zip_source.unextracted:
+                continue
+            if not lexists(path):
+                log.debug("dropping deleted member %s", name)
+                continue
+            seen.add(name)
+            seen.update(get_parent_names(name))
+            if zip_source.is_unchanged(name, path):
+                copy_member(source_zipfile_obj, info, zipfile_obj)
+                copied += 1
+            else:
+                zipfile_obj.write(path, name)
+                written += 1
+
+        # anything else is new, e.g. a seal that wasn't there before
+        for path, name in walk_tree(source_dir, followlinks=False):
+            if name not in seen:
+                zipfile_obj.write(path, name)
+                written += 1
+    finally:
+        zipfile_obj.close()
+        source_zipfile_obj.close()
+    log.debug("repacked %s: %d members copied, %d written",
+              output_path, copied, written)
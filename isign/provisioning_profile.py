@@ -0,0 +1,186 @@
+""" Reads provisioning profiles (.mobileprovision files).
+
+    A profile is a plist, wrapped in a CMS signed-data envelope. We unwrap
+    it in-process with a small BER reader, which is all we need to get at
+    the content. Unlike `openssl smime -verify -noverify`, this doesn't
+    check the envelope's signature; if the envelope is anything we don't
+    expect, we hand it to openssl after all.
+
+    The same few profiles tend to be used for many jobs, so decoded
+    profiles are cached by a digest of their contents. """
+
+import biplist
+from collections import OrderedDict
+import hashlib
+import logging
+from signer import openssl_command
+import threading
+
+PROFILE_CACHE_SIZE = 100
+SIGNED_DATA_OID = '\x2a\x86\x48\x86\xf7\x0d\x01\x07\x02'  # 1.2.840.113549.1.7.2
+
+# BER tags we need
+SEQUENCE = 0x30
+OID = 0x06
+OCTET_STRING = 0x04
+CONSTRUCTED_OCTET_STRING = 0x24
+CONTEXT_0 = 0xa0
+
+log = logging.getLogger(__name__)
+
+
+def read_element(data, offset):
+    """ The BER element at offset, as (tag, content start, content end,
+        element end). Handles indefinite lengths """
+    tag = ord(data[offset])
+    if tag & 0x1f == 0x1f:
+        raise ValueError("unexpected high tag number at {0}".format(offset))
+    length = ord(data[offset + 1])
+    content_start = offset + 2
+    if length == 0x80:
+        # indefinite length, ends with two zero bytes
+        position = content_start
+        while data[position:position + 2] != '\x00\x00':
+            position = read_element(data, position)[3]
+            if position >= len(data):
+                raise ValueError("unterminated element at {0}".format(offset))
+        return (tag, content_start, position, position + 2)
+    if length & 0x80:
+        num_bytes = length & 0x7f
+        if num_bytes == 0 or num_bytes > 4:
+            raise ValueError("bad length at {0}".format(offset))
+        length = 0
+        for byte in data[content_start:content_start + num_bytes]:
+            length = (length << 8) | ord(byte)
+        content_start += num_bytes
+    content_end = content_start + length
+    if content_end > len(data):
+        raise ValueError("element at {0} runs past the end".format(offset))
+    return (tag, content_start, content_end, content_end)
+
+
+def read_children(data, element):
+    """ The elements inside a constructed element """
+    _, position, content_end, _ = element
+    children = []
+    while position < content_end:
+        child = read_element(data, position)
+        children.append(child)
+        position = child[3]
+    return children
+
+
+def expect(element, tag):
+    if element[0] != tag:
+        raise ValueError("expected tag {0:#x}, got {1:#x}".format(tag, element[0]))
+    return element
+
+
+def read_octet_string(data, element):
+    """ Value of an octet string, which BER allows to come in pieces """
+    if element[0] == OCTET_STRING:
+        return data[element[1]:element[2]]
+    expect(element, CONSTRUCTED_OCTET_STRING)
+    return ''.join(read_octet_string(data, child)
+                   for child in read_children(data, element))
+
+
+def get_signed_content(data):
+    """ The content of a CMS signed-data envelope, without
+        verifying anything """
+    content_info = read_children(data, expect(read_element(data, 0), SEQUENCE))
+    oid = expect(content_info[0], OID)
+    if data[oid[1]:oid[2]] != SIGNED_DATA_OID:
+        raise ValueError("not signed data")
+    signed_data = expect(read_children(data, expect(content_info[1], CONTEXT_0))[0],
+                         SEQUENCE)
+    # version, digest algorithms, then the encapsulated content
+    encap_content_info = expect(read_children(data, signed_data)[2], SEQUENCE)
+    explicit_content = read_children(data, encap_content_info)[1]
+    content = read_children(data, expect(explicit_content, CONTEXT_0))[0]
+    return read_octet_string(data, content)
+
+
+def get_signed_content_with_openssl(path, command=openssl_command):
+    """ Same as get_signed_content, by asking openssl """
+    cmd = [
+        'smime',
+        '-inform', 'der',
+        '-verify',    # verifies content, prints verification status to STDERR,
+                      #  outputs content to STDOUT. In our case, will be an XML plist
+        '-noverify',  # accept self-signed certs. Not the opposite of -verify!
+        '-in', path
+    ]
+    # this command always prints 'Verification successful' to stderr.
+    (content, err) = command(cmd, data=None, expect_err=True)
+    if err and err.strip() != 'Verification successful':
+        log.error('Received unexpected error from openssl: {}'.format(err))
+    return content
+
+
+class ProvisioningProfile(object):
+    """ What's in a profile. Treat as read-only; it may be shared """
+
+    def __init__(self, digest, plist):
+        self.digest = digest
+        self.plist = plist
+        self.entitlements = plist.get('Entitlements')
+        self.team_ids = plist.get('TeamIdentifier', [])
+        self.expiration_date = plist.get('ExpirationDate')
+        # only development and ad hoc profiles have these
+        self.devices = plist.get('ProvisionedDevices')
+
+
+class ProfileCache(object):
+    """ Decoded profiles by the SHA-256 of their contents, keeping at
+        most max_size of the most recently used. Thread-safe """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.profiles = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, command=openssl_command):
+        """ The ProvisioningProfile in this file. If we can't decode it
+            ourselves, command runs openssl to do it, as openssl_command
+            does """
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            profile = self.profiles.pop(digest, None)
+            if profile is not None:
+                self.profiles[digest] = profile
+                self.hits += 1
+                return profile
+            self.misses += 1
+        try:
+            content = get_signed_content(data)
+        except (ValueError, IndexError) as e:
+            log.debug("decoding %s with openssl: %s", path, e)
+            content = get_signed_content_with_openssl(path, command)
+        profile = ProvisioningProfile(digest, biplist.readPlistFromString(content))
+        with self.lock:
+            self.profiles[digest] = profile
+            while len(self.profiles) > self.max_size:
+                self.profiles.popitem(last=False)
+        return profile
+
+    def clear(self):
+        with self.lock:
+            self.profiles.clear()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.profiles)
+
+
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE)
+
+
+def load(path, command=openssl_command):
+    """ The ProvisioningProfile in this file, from the cache if we've
+        seen one like it """
+    return profile_cache.get(path, command)
@@ -6,27 +6,55 @@
 #
 
 from abc import ABCMeta
+import code_resources
 from codesig import (Codesig,
                      EntitlementsSlot,
                      ResourceDirSlot,
                      RequirementsSlot,
                      ApplicationSlot,
                      InfoSlot)
+from construct.lib.container import LazyContainer
 import logging
 import macho
 from makesig import make_signature
 import os
+import shutil
 import tempfile
 import utils
 
 log = logging.getLogger(__name__)
 
 
+def set_lazy_stream(obj, stream):
+    """ construct parses some things lazily, and reads them from the stream
+        it parsed from when they're needed. Make everything in obj that
+        hasn't been read yet read from this stream instead """
+    if isinstance(obj, LazyContainer):
+        if obj.has_value:
+            set_lazy_stream(obj.value, stream)
+        else:
+            obj.stream = stream
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            set_lazy_stream(value, stream)
+    elif isinstance(obj, list):
+        for value in obj:
+            set_lazy_stream(value, stream)
+
+
 class Signable(object):
     __metaclass__ = ABCMeta
 
     slot_classes = []
 
+    # If the new code signatures fit where the old ones were, patch the file
+    # where it is, rather than writing a new copy. Only do this to files
+    # nobody else has a link to.
+    sign_in_place = True
+
+    # Work on the slices of a fat binary at the same time
+    concurrent_slices = True
+
     def __init__(self, bundle, path, signer):
         log.debug("working on {0}".format(path))
         self.bundle = bundle
@@ -45,30 +73,49 @@ class Signable(object):
         self.arches = self._parse_arches()
 
 
+    def _map_arches(self, func, items):
+        """ func applied to each of items, one per slice, concurrently if
+            we can. Results are in the same order as items """
+        if not self.concurrent_slices:
+            return [func(item) for item in items]
+        return utils.map_threaded(func, items)
+
     def _parse_arches(self):
         """ parse architectures and associated Codesig """
         arch_macho = self.m.data
-        arches = []
         if 'FatArch' in arch_macho:
             log.debug('found fat binary')
-            for i, arch in enumerate(arch_macho.FatArch):
+
+            def get_fat_arch(i):
+                arch = arch_macho.FatArch[i]
                 log.debug('found fat slice: cputype {}, cpusubtype {}'.format(arch.cputype, arch.cpusubtype))
-                this_arch_macho = arch.MachO
                 log.debug('slice {}: arch offset: {}, size: {}'.format(i, arch.offset, arch.size))
-                arch_object = self._get_arch(this_arch_macho,
-                                             arch.offset,
-                                             arch.size)
+                # each slice gets its own file handle, so they can be read at
+                # once. That includes the bits construct reads lazily
+                with open(self.path, "rb") as f:
+                    set_lazy_stream(arch.MachO, f)
+                    try:
+                        arch_object = self._get_arch(arch.MachO,
+                                                     arch.offset,
+                                                     arch.size,
+                                                     f)
+                    finally:
+                        set_lazy_stream(arch.MachO, self.f)
                 arch_object['fat_index'] = i
-                arches.append(arch_object)
+                return arch_object
+
+            arches = self._map_arches(get_fat_arch,
+                                      range(len(arch_macho.FatArch)))
         else:
             log.debug('found thin binary: cputype {}, cpusubtype {}'.format(arch_macho.cputype, arch_macho.cpusubtype))
-            arches.append(self._get_arch(arch_macho,
-                                         0,
-                                         self.file_end))
+            arches = [self._get_arch(arch_macho,
+                                     0,
+                                     self.file_end,
+                                     self.f)]
 
         return arches
 
-    def _get_arch(self, macho, arch_offset, arch_size):
+    def _get_arch(self, macho, arch_offset, arch_size, f):
         arch = {'macho': macho, 'arch_offset': arch_offset, 'arch_size': arch_size}
 
         arch['cmds'] = {}
@@ -81,36 +128,26 @@ class Signable(object):
         if 'LC_CODE_SIGNATURE' in arch['cmds']:
             arch['lc_codesig'] = arch['cmds']['LC_CODE_SIGNATURE']
             codesig_offset = arch['macho'].macho_start + arch['lc_codesig'].data.dataoff
-            self.f.seek(codesig_offset)
-            codesig_data = self.f.read(arch['lc_codesig'].data.datasize)
+            f.seek(codesig_offset)
+            codesig_data = f.read(arch['lc_codesig'].data.datasize)
             # log.debug("codesig len: {0}".format(len(codesig_data)))
         else:
             log.info("signing from scratch!")
             self.sign_from_scratch = True
             entitlements_file = self.bundle.get_entitlements_path()  #'/path/to/some/entitlements.plist'
 
-            # Stage 1: Fake signature
-            fake_codesig_data = make_signature(macho, arch_offset, arch_size, arch['cmds'], self.f, entitlements_file, 0, self.signer, self.bundle.get_info_prop('CFBundleIdentifier'))
-
-            macho.ncmds -= 1
-            macho.commands = macho.commands[:-1]
-
-            # Get the length
-            fake_codesig = Codesig(self, fake_codesig_data)
-            fake_codesig.set_signature(self.signer)
-            fake_codesig.update_offsets()
-            fake_codesig_length = len(fake_codesig.build_data())
-
-            log.debug("fake codesig length: {}".format(fake_codesig_length))
-
-            # stage 2: real signature
-            codesig_data = make_signature(macho, arch_offset, arch_size, arch['cmds'], self.f, entitlements_file, fake_codesig_length, self.signer, self.bundle.get_info_prop('CFBundleIdentifier'))
-
+            # Make the signature with room for the real CMS signature, which
+            # goes in when we sign
+            codesig_data = make_signature(macho, arch_offset, arch_size, arch['cmds'], f, entitlements_file, None, self.signer, self.bundle.get_info_prop('CFBundleIdentifier'))
 
             arch['lc_codesig'] = arch['cmds']['LC_CODE_SIGNATURE']
 
         arch['codesig'] = Codesig(self, codesig_data)
-        arch['codesig_len'] = len(codesig_data)
+        if self.sign_from_scratch:
+            # all the space reserved for it, not just what it uses so far
+            arch['codesig_len'] = arch['lc_codesig'].data.datasize
+        else:
+            arch['codesig_len'] = len(codesig_data)
 
         if self.sign_from_scratch:
             arch['codesig_data'] = codesig_data
@@ -126,6 +163,11 @@ class Signable(object):
         log.debug("new codesig len is: {0}".format(new_codesig_len))
 
         padding_length = arch['codesig_len'] - new_codesig_len
+        if self.sign_from_scratch and padding_length < 0:
+            # the space was reserved in __LINKEDIT, we can't just grow it
+            raise Exception("Code signature is {0} bytes, but only {1} were "
+                            "reserved for it".format(new_codesig_len,
+                                                     arch['codesig_len']))
         new_codesig_data += "\x00" * padding_length
         # log.debug("padded len: {0}".format(len(new_codesig_data)))
         # log.debug("----")
@@ -166,26 +208,28 @@ class Signable(object):
 
     def sign(self, app, signer):
 
-        temp = tempfile.NamedTemporaryFile('wb', delete=False)
-
         # If signing fat binary from scratch, need special handling
 
         # TODO: we assume that if any slice is unsigned, all slices are.  This should be true in practice but
         # we should still guard against this.
         if self.sign_from_scratch and 'FatArch' in self.m.data:
             assert len(self.arches) >= 2
+            temp = tempfile.NamedTemporaryFile('wb', delete=False)
 
             # todo(markwang): Update fat headers and mach_start for each slice if needewd
             log.debug('signing fat binary from scratch')
 
             sorted_archs = sorted(self.arches, key=lambda arch: arch['arch_offset'])
 
+            # sign the slices, then lay them out one after another
+            signed_archs = self._map_arches(lambda arch: self._sign_arch(arch, app, signer),
+                                            sorted_archs)
 
             prev_arch_end = 0
-            for arch in sorted_archs:
+            for arch, signed_arch in zip(sorted_archs, signed_archs):
                 fatentry = arch['macho'] # has pointert to container
 
-                codesig_arch_offset, new_codesig_data = self._sign_arch(arch, app, signer)
+                codesig_arch_offset, new_codesig_data = signed_arch
                 codesig_file_offset = arch['arch_offset'] + codesig_arch_offset
                 log.debug('existing arch slice: cputype {}, cpusubtype {}, offset {}, size {}'.format(fatentry.cputype, fatentry.cpusubtype, arch['arch_offset'], arch['arch_size']))
                 log.debug("codesig arch offset: {2}, file offset: {0}, len: {1}".format(codesig_file_offset,
@@ -214,7 +258,7 @@ class Signable(object):
             for arch in reversed(sorted_archs):
                 self.f.seek(arch['old_arch_offset'])
                 temp.seek(arch['arch_offset'])
-                temp.write(self.f.read(arch['old_arch_size']))
+                utils.copy_range(self.f, temp, arch['old_arch_size'])
 
                 temp.seek(arch['arch_offset'] + arch['codesig_arch_offset'])
                 temp.write(arch['codesig_data'])
@@ -226,20 +270,34 @@ class Signable(object):
 
 
         else:
-            # copy self.f into temp, reset to beginning of file
-            self.f.seek(0)
-            temp.write(self.f.read())
-            temp.seek(0)
-
-            # write new codesign blocks for each arch
+            # make new codesign blocks for each arch
             offset_fmt = ("offset: {2}, write offset: {0}, "
                           "new_codesig_data len: {1}")
-            for arch in self.arches:
-                offset, new_codesig_data = self._sign_arch(arch, app, signer)
+            codesig_writes = []
+            fits = not self.sign_from_scratch
+            signed_archs = self._map_arches(lambda arch: self._sign_arch(arch, app, signer),
+                                            self.arches)
+            for arch, (offset, new_codesig_data) in zip(self.arches, signed_archs):
                 write_offset = arch['macho'].macho_start + offset
                 log.debug(offset_fmt.format(write_offset,
                                             len(new_codesig_data),
                                             offset))
+                codesig_writes.append((write_offset, new_codesig_data))
+                if len(new_codesig_data) > arch['codesig_len']:
+                    fits = False
+
+            # a file with other links to it might be shared with another
+            # copy of the app (see clone.py), so it must be replaced, not
+            # written to
+            if fits and self.sign_in_place and os.stat(self.path).st_nlink == 1:
+                self._sign_in_place(codesig_writes)
+                return
+
+            # copy self.f into temp, then write the new blocks over it
+            temp = tempfile.NamedTemporaryFile('wb', delete=False)
+            self.f.seek(0)
+            shutil.copyfileobj(self.f, temp, utils.COPY_BLOCKSIZE)
+            for write_offset, new_codesig_data in codesig_writes:
                 temp.seek(write_offset)
                 temp.write(new_codesig_data)
 
@@ -253,6 +311,20 @@ class Signable(object):
         os.chmod(temp.name, mode)
         # log.debug("moving temporary file to {0}".format(self.path))
         os.rename(temp.name, self.path)
+        code_resources.invalidate_hash(self.path)
+
+    def _sign_in_place(self, codesig_writes):
+        """ Write new code signatures and headers straight into the file. Only
+            safe if the headers stay the same size, and each signature fits
+            in the space the old one had """
+        log.debug("signing {0} in place".format(self.path))
+        with open(self.path, 'r+b') as f:
+            for write_offset, new_codesig_data in codesig_writes:
+                f.seek(write_offset)
+                f.write(new_codesig_data)
+            f.seek(0)
+            macho.MachoFile.build_stream(self.m, f)
+        code_resources.invalidate_hash(self.path)
 
 
 class Executable(Signable):
@@ -2,10 +2,12 @@
 # Small object that can be passed around easily, that represents
 # our signing credentials, and can sign data.
 #
-# Unfortunately the installed python OpenSSL library doesn't
-# offer what we need for cms, so we also need to shell out to the openssl
-# tool, and make sure it's the right version.
+# Unfortunately older versions of the python OpenSSL library don't
+# offer what we need for cms, so we may need to shell out to the openssl
+# tool, and make sure it's the right version. Newer versions of
+# cryptography (3.2+) can make the signatures in-process.
 
+from collections import namedtuple
 from distutils import spawn
 from exceptions import (ImproperCredentials,
                         MissingCredentials,
@@ -17,10 +19,29 @@ import os.path
 import subprocess
 import re
 
+try:
+    from cryptography import x509
+    from cryptography.exceptions import UnsupportedAlgorithm
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.serialization import pkcs7
+    pkcs7.PKCS7SignatureBuilder
+except (ImportError, AttributeError):
+    pkcs7 = None
+
 OPENSSL = os.getenv('OPENSSL', spawn.find_executable('openssl', os.getenv('PATH', '')))
 # modern OpenSSL versions look like '0.9.8zd'. Use a regex to parse
 OPENSSL_VERSION_RE = re.compile(r'(\d+).(\d+).(\d+)(\w*)')
 MINIMUM_OPENSSL_VERSION = '1.0.1'
+# Room in a CMS signature for everything but the certificates and the
+# signature value itself: signed attributes, algorithm identifiers, the
+# signer's issuer and serial number, and DER framing. Generous, as
+# codesign_allocate is, because running out of room is fatal
+SIGNATURE_OVERHEAD = 2048
+# openssl executables whose version we've checked
+checked_openssl_versions = set()
+PEM_CERTIFICATE_RE = re.compile(r'-----BEGIN CERTIFICATE-----.*?-----END CERTIFICATE-----',
+                                re.DOTALL)
 
 log = logging.getLogger(__name__)
 
@@ -61,6 +82,18 @@ def get_installed_openssl_version():
     return re.split(r'\s+', version_line)[1]
 
 
+def check_openssl_version():
+    """ Warn if the openssl tool is too old. Only checks each openssl
+        once per process """
+    if OPENSSL in checked_openssl_versions:
+        return
+    checked_openssl_versions.add(OPENSSL)
+    openssl_version = get_installed_openssl_version()
+    if not is_openssl_version_ok(openssl_version, MINIMUM_OPENSSL_VERSION):
+        msg = "Signing may not work: OpenSSL version is {0}, need {1} !"
+        log.warn(msg.format(openssl_version, MINIMUM_OPENSSL_VERSION))
+
+
 def is_openssl_version_ok(version, minimum):
     """ check that the openssl tool is at least a certain version """
     version_tuple = openssl_version_to_tuple(version)
@@ -77,41 +110,153 @@ def openssl_version_to_tuple(s):
     return ()
 
 
+def get_team_id(cert):
+    """ The team ID is the Apple Organizational Unit in a cert's subject.
+        If there's more than one OU, it's the last """
+    team_id = None
+    for key, value in cert.get_subject().get_components():
+        if key == 'OU':
+            team_id = value
+    return team_id
+
+
+def load_cms_objects(key_pem, cert_pem, chain_pems):
+    """ The key, signer cert and chain as cryptography objects, for
+        signing in-process, or Nones if we can't """
+    if pkcs7 is None:
+        return (None, None, ())
+    backend = default_backend()
+    try:
+        key = serialization.load_pem_private_key(key_pem, None, backend)
+    except (ValueError, TypeError, UnsupportedAlgorithm) as e:
+        log.debug("Can't sign in-process with this key: {0}".format(e))
+        return (None, None, ())
+    cert = x509.load_pem_x509_certificate(cert_pem, backend)
+    chain = tuple(x509.load_pem_x509_certificate(chain_pem, backend)
+                  for chain_pem in chain_pems)
+    return (key, cert, chain)
+
+
+class Credentials(namedtuple('Credentials', ['signer_key_file',
+                                             'signer_cert_file',
+                                             'apple_cert_file',
+                                             'common_name',
+                                             'team_id',
+                                             'cert_der',
+                                             'chain_der',
+                                             'signature_size',
+                                             'key',
+                                             'cert',
+                                             'chain'])):
+    """ Everything we need to know about a set of signing credentials,
+        read from their files once. Immutable, so it can be shared.
+        key, cert and chain are cryptography objects for signing
+        in-process, or None if that's not possible """
+    __slots__ = ()
+
+    @classmethod
+    def load(cls, signer_key_file, signer_cert_file, apple_cert_file):
+        for filename in [signer_key_file, signer_cert_file, apple_cert_file]:
+            if filename is None or not os.path.exists(filename):
+                msg = "Can't find {0}".format(filename)
+                log.warn(msg)
+                raise MissingCredentials(msg)
+        with open(signer_key_file, 'rb') as fh:
+            key_pem = fh.read()
+        with open(signer_cert_file, 'rb') as fh:
+            cert_pem = fh.read()
+        with open(apple_cert_file, 'rb') as fh:
+            chain_pems = PEM_CERTIFICATE_RE.findall(fh.read())
+        try:
+            key = crypto.load_privatekey(crypto.FILETYPE_PEM, key_pem)
+            cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert_pem)
+            chain = [crypto.load_certificate(crypto.FILETYPE_PEM, chain_pem)
+                     for chain_pem in chain_pems]
+        except crypto.Error as e:
+            raise ImproperCredentials("Can't read credentials: {0}".format(e))
+
+        team_id = get_team_id(cert)
+        if team_id is None:
+            raise ImproperCredentials("Cert file does not contain Subject line"
+                                      "with Apple Organizational Unit (OU)")
+        common_name = dict(cert.get_subject().get_components()).get('CN')
+        cert_der = crypto.dump_certificate(crypto.FILETYPE_ASN1, cert)
+        chain_der = tuple(crypto.dump_certificate(crypto.FILETYPE_ASN1, chain_cert)
+                          for chain_cert in chain)
+        # Upper bound on the size of a signature made with these, so we can
+        # reserve space for it before we have it
+        signature_size = (len(cert_der) + sum(len(der) for der in chain_der) +
+                          (key.bits() + 7) // 8 + SIGNATURE_OVERHEAD)
+        return cls(signer_key_file, signer_cert_file, apple_cert_file,
+                   common_name, team_id, cert_der, chain_der, signature_size,
+                   *load_cms_objects(key_pem, cert_pem, chain_pems))
+
+
 class Signer(object):
     """ collaborator, holds the keys, identifiers for signer,
         and knows how to sign data """
+
+    # Make signatures with the cryptography library, if it's new enough,
+    # rather than with the openssl tool
+    in_process_cms = True
+
     def __init__(self,
                  signer_key_file=None,
                  signer_cert_file=None,
                  apple_cert_file=None,
-                 team_id=None):
+                 team_id=None,
+                 credentials=None):
         """ signer_key_file = your org's key .pem
             signer_cert_file = your org's cert .pem
             apple_cert_file = apple certs in .pem form
-            team_id = your Apple Organizational Unit code """
-        for filename in [signer_key_file, signer_cert_file, apple_cert_file]:
-            if not os.path.exists(filename):
-                msg = "Can't find {0}".format(filename)
-                log.warn(msg)
-                raise MissingCredentials(msg)
-        self.signer_key_file = signer_key_file
-        self.signer_cert_file = signer_cert_file
-        self.apple_cert_file = apple_cert_file
-        self.team_id = None
-        team_id = self._get_team_id()
-        if team_id is None:
-            raise ImproperCredentials("Cert file does not contain Subject line"
-                                      "with Apple Organizational Unit (OU)")
-        self.check_openssl_version()
+            team_id = your Apple Organizational Unit code
+            credentials = a Credentials, already loaded, instead of the files.
+            Cheap if credentials are given: nothing is read, nothing forked """
+        if credentials is None:
+            credentials = Credentials.load(signer_key_file,
+                                           signer_cert_file,
+                                           apple_cert_file)
+        self.credentials = credentials
+        self.signer_key_file = credentials.signer_key_file
+        self.signer_cert_file = credentials.signer_cert_file
+        self.apple_cert_file = credentials.apple_cert_file
+        self.team_id = credentials.team_id
 
     def check_openssl_version(self):
-        openssl_version = get_installed_openssl_version()
-        if not is_openssl_version_ok(openssl_version, MINIMUM_OPENSSL_VERSION):
-            msg = "Signing may not work: OpenSSL version is {0}, need {1} !"
-            log.warn(msg.format(openssl_version, MINIMUM_OPENSSL_VERSION))
+        check_openssl_version()
 
     def sign(self, data):
-        """ sign data, return filehandle """
+        """ sign data, return signature as DER """
+        if self.in_process_cms and self.credentials.key is not None:
+            try:
+                return self._sign_in_process(data)
+            except (ValueError, TypeError, UnsupportedAlgorithm) as e:
+                log.warn("Could not sign in-process, using openssl: {0}".format(e))
+                self.in_process_cms = False
+        return self._sign_with_openssl(data)
+
+    def _sign_in_process(self, data):
+        """ The same kind of signature as _sign_with_openssl: detached,
+            binary, SHA-256, with the Apple certs, and no S/MIME
+            capabilities. Not byte-identical, because the signing time
+            differs """
+        builder = pkcs7.PKCS7SignatureBuilder().set_data(data)
+        builder = builder.add_signer(self.credentials.cert,
+                                     self.credentials.key,
+                                     hashes.SHA256())
+        for apple_cert in self.credentials.chain:
+            builder = builder.add_certificate(apple_cert)
+        signature = builder.sign(serialization.Encoding.DER,
+                                 [pkcs7.PKCS7Options.DetachedSignature,
+                                  pkcs7.PKCS7Options.Binary,
+                                  pkcs7.PKCS7Options.NoCapabilities])
+        log.debug("in length: {}, out length: {}".format(len(data), len(signature)))
+        if len(signature) < 128:
+            raise OpenSslFailure("In-process signature seems too small "
+                                 "({0} bytes)".format(len(signature)))
+        return signature
+
+    def _sign_with_openssl(self, data):
         cmd = [
             "cms",
             "-sign", "-binary", "-nosmimecap",
@@ -121,6 +266,7 @@ class Signer(object):
             "-keyform", "pem",
             "-outform", "DER"
         ]
+        self.check_openssl_version()
         signature = openssl_command(cmd, data)
         log.debug("in length: {}, out length: {}".format(len(data), len(signature)))
         # in some cases we've seen this return a zero length file.
@@ -132,12 +278,14 @@ class Signer(object):
                                                       len(signature)))
         return signature
 
+    def get_signature_size(self):
+        """ Upper bound on the size of a signature from sign(), so we can
+            reserve space for it before we have it """
+        return self.credentials.signature_size
+
     def get_common_name(self):
-        """ read in our cert, and get our Common Name """
-        with open(self.signer_cert_file, 'rb') as fh:
-            cert = crypto.load_certificate(crypto.FILETYPE_PEM, fh.read())
-        subject = cert.get_subject()
-        return dict(subject.get_components())['CN']
+        """ our cert's Common Name """
+        return self.credentials.common_name
 
     def _log_parsed_asn1(self, data):
         cmd = ['asn1parse', '-inform', 'DER' '-i']
@@ -146,25 +294,7 @@ class Signer(object):
 
     def _get_team_id(self):
         """ Same as Apple Organizational Unit. Should be in the cert """
-        if self.team_id:
-            return self.team_id
-
-        team_id = None
-        cmd = [
-            'x509',
-            '-in', self.signer_cert_file,
-            '-text',
-            '-noout'
-        ]
-        certificate_info = openssl_command(cmd)
-        subject_with_ou_match = re.compile(r'\s+Subject:.*OU\s?=\s?(\w+)')
-        for line in certificate_info.splitlines():
-            match = subject_with_ou_match.match(line)
-            if match is not None:
-                team_id = match.group(1)
-                break
-        self.team_id = team_id
-        return team_id
+        return self.team_id
 
     def is_adhoc(self):
         return False
@@ -177,6 +307,9 @@ class AdhocSigner(Signer):
         """Return empty signature"""
         return ''
 
+    def get_signature_size(self):
+        return 0
+
     def is_adhoc(self):
         return True
 
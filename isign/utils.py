@@ -1,4 +1,9 @@
 import binascii
+import Queue
+import sys
+import threading
+
+COPY_BLOCKSIZE = 1024 * 1024
 
 
 def print_data(data):
@@ -16,3 +21,115 @@ def print_structure(container, struct):
     actual_data = struct.build(container)
     return "{}".format(struct.parse(actual_data))
 
+
+
+def copy_range(source, dest, length, blocksize=COPY_BLOCKSIZE):
+    """ copy length bytes from the current position in file object source
+        to the current position in dest, a block at a time. Returns the
+        number of bytes copied, which is less than length at end of file """
+    copied = 0
+    while copied < length:
+        buf = source.read(min(blocksize, length - copied))
+        if not buf:
+            break
+        dest.write(buf)
+        copied += len(buf)
+    return copied
+
+
+def map_threaded(func, items, workers=None):
+    """ Like map(func, items), but with up to this many threads at once
+        (by default one per item). Results are in the same order as items.
+        If func raises, the first exception is re-raised here.
+
+        multiprocessing's ThreadPool takes up to a tenth of a second to shut
+        down, which is a lot when the work is short. """
+    items = list(items)
+    if workers is None:
+        workers = len(items)
+    workers = min(workers, len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+    results = [None] * len(items)
+    errors = []
+    indexes = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if errors:
+                    return
+                i = next(indexes, None)
+            if i is None:
+                return
+            try:
+                results[i] = func(items[i])
+            except Exception:
+                with lock:
+                    errors.append(sys.exc_info())
+                return
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+
+def run_pipeline(items, stages, queue_size=1, finish=None):
+    """ Pass each item through each of stages, functions of one item, in
+        order. Each stage runs on its own thread, so while one item is in
+        the second stage, the next can be in the first, and so on. At most
+        queue_size items wait between two stages.
+
+        If a stage raises, that item skips the stages after it. finish, if
+        given, is called with every item at the end, even those that failed.
+
+        Returns the exception each item raised, or None, in the same order
+        as items """
+    items = list(items)
+    errors = [None] * len(items)
+    queues = [Queue.Queue(queue_size) for _ in stages[1:]]
+
+    def get_indexes(stage_index):
+        if stage_index == 0:
+            for i in range(len(items)):
+                yield i
+            return
+        while True:
+            i = queues[stage_index - 1].get()
+            if i is None:
+                return
+            yield i
+
+    def run_stage(stage_index, stage):
+        last = stage_index == len(stages) - 1
+        for i in get_indexes(stage_index):
+            if errors[i] is None:
+                try:
+                    stage(items[i])
+                except Exception as e:
+                    errors[i] = e
+            if not last:
+                queues[stage_index].put(i)
+            elif finish is not None:
+                try:
+                    finish(items[i])
+                except Exception as e:
+                    if errors[i] is None:
+                        errors[i] = e
+        if not last:
+            queues[stage_index].put(None)
+
+    threads = [threading.Thread(target=run_stage, args=(stage_index, stage))
+               for stage_index, stage in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
@@ -41,7 +41,7 @@ setup(
     install_requires=[
         'biplist==0.9',
         'construct==2.5.2',
-        'memoizer==0.0.1',
+        'cryptography>=3.2',
         'pyOpenSSL==0.15.1'
     ],
     package_data={
@@ -52,5 +52,6 @@ setup(
     scripts=['bin/isign',
              'bin/multisign',
              'bin/isign_export_creds.sh',
-             'bin/isign_guess_mobileprovision.sh']
+             'bin/isign_guess_mobileprovision.sh',
+             'bin/isign_prune_digest_store']
 )
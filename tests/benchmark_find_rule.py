@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+""" Compare ResourceBuilder.find_rule with the linear matcher it replaced,
+    on a synthetic bundle of 50,000 paths. Not a test; run it directly:
+
+        python tests/benchmark_find_rule.py """
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from isign import code_resources  # noqa: E402
+
+NUM_PATHS = 50000
+REPEAT = 3
+
+
+def get_synthetic_paths(num_paths):
+    """ paths like you'd see in a large app """
+    templates = ['Assets{0}.car',
+                 'img/icon{0}@2x.png',
+                 'en.lproj/Localizable{0}.strings',
+                 'Base.lproj/Main{0}.storyboardc/Info.plist',
+                 'Frameworks/Lib{0}.framework/Lib{0}',
+                 'PlugIns/Ext{0}.appex/Info.plist',
+                 'fonts/Font{0}.ttf',
+                 'data/level{0}/map.json',
+                 'Thing{0}.nib',
+                 'sub/dir/.DS_Store']
+    return [templates[i % len(templates)].format(i) for i in xrange(num_paths)]
+
+
+def main():
+    paths = get_synthetic_paths(NUM_PATHS)
+    template = code_resources.get_template()
+    builder = code_resources.ResourceBuilder('/tmp/Synthetic.app/Synthetic',
+                                             template['rules2'])
+    for path in paths:
+        assert builder.find_rule(path) is builder.find_rule_linear(path)
+
+    for name in ['find_rule_linear', 'find_rule']:
+        method = getattr(builder, name)
+        timer = timeit.Timer(lambda: [method(path) for path in paths])
+        best = min(timer.repeat(repeat=REPEAT, number=1))
+        print '{0:>18}: {1:.3f}s for {2} paths'.format(name, best, len(paths))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,12 @@
 from isign_base_test import IsignBaseTest
 from isign.archive import archive_factory, Archive, AppArchive, AppZipArchive, IpaArchive
+from isign.code_resources import make_seal
+from isign import native_zip
 import logging
+import os
+from os.path import join, relpath
+import stat
+import zipfile
 
 log = logging.getLogger(__name__)
 
@@ -81,3 +87,162 @@ class TestArchivePrecheck(IsignBaseTest):
         assert IpaArchive.precheck(self.TEST_APP) is False
         assert IpaArchive.precheck(self.TEST_APPZIP) is False
         assert IpaArchive.precheck(self.TEST_NONAPP_IPA) is False
+
+
+class TestNativeZip(IsignBaseTest):
+
+    def _get_tree(self, path):
+        """ map of relative path -> (permission bits, contents) """
+        tree = {}
+        for root, dirs, filenames in os.walk(path):
+            for filename in filenames:
+                file_path = join(root, filename)
+                with open(file_path, 'rb') as fh:
+                    contents = fh.read()
+                mode = stat.S_IMODE(os.stat(file_path).st_mode)
+                tree[relpath(file_path, path)] = (mode, contents)
+        return tree
+
+    def _unarchive(self, path, use_native_zip):
+        archive = archive_factory(path)
+        archive.use_native_zip = use_native_zip
+        return archive.unarchive_to_temp()
+
+    def test_native_unarchive_matches_helpers(self):
+        native_ua = self._unarchive(self.TEST_IPA, True)
+        helper_ua = self._unarchive(self.TEST_IPA, False)
+        try:
+            assert self._get_tree(native_ua.path) == self._get_tree(helper_ua.path)
+        finally:
+            native_ua.remove()
+            helper_ua.remove()
+
+    def test_extract_directory_attributes(self):
+        zip_path = self.get_temp_file()
+        target_dir = self.get_temp_dir()
+        try:
+            zipfile_obj = zipfile.ZipFile(zip_path, 'w')
+            dir_info = zipfile.ZipInfo('Payload/', (2010, 1, 2, 3, 4, 6))
+            dir_info.external_attr = (stat.S_IFDIR | 0750) << 16
+            zipfile_obj.writestr(dir_info, '')
+            file_info = zipfile.ZipInfo('Payload/file', (2011, 1, 2, 3, 4, 6))
+            file_info.external_attr = 0640 << 16
+            zipfile_obj.writestr(file_info, 'contents')
+            zipfile_obj.close()
+            native_zip.extract(zip_path, target_dir)
+            dir_stat = os.stat(join(target_dir, 'Payload'))
+            assert stat.S_IMODE(dir_stat.st_mode) == 0750
+            assert dir_stat.st_mtime == native_zip.get_member_mtime(dir_info)
+            file_stat = os.stat(join(target_dir, 'Payload', 'file'))
+            assert stat.S_IMODE(file_stat.st_mode) == 0640
+        finally:
+            self.unlink(zip_path)
+            self.unlink(target_dir)
+
+    def test_native_archive_round_trip(self):
+        ua = self._unarchive(self.TEST_IPA, True)
+        output_path = self.get_temp_file() + '.ipa'
+        try:
+            IpaArchive.archive(ua.path, output_path)
+            original_names = set(zipfile.ZipFile(self.TEST_IPA).namelist())
+            names = set(zipfile.ZipFile(output_path).namelist())
+            assert names == original_names
+            round_trip_ua = self._unarchive(output_path, True)
+            try:
+                assert self._get_tree(round_trip_ua.path) == self._get_tree(ua.path)
+            finally:
+                round_trip_ua.remove()
+        finally:
+            ua.remove()
+            self.unlink(output_path)
+
+    def test_repack_copies_unchanged_members(self):
+        ua = self._unarchive(self.TEST_IPA, True)
+        assert ua.zip_source is not None
+        app_dir = join(ua.path, ua.relative_bundle_dir)
+        changed_name = join(ua.relative_bundle_dir, 'PkgInfo')
+        deleted_name = join(ua.relative_bundle_dir, 'Assets.car')
+        new_name = join(ua.relative_bundle_dir, 'NewFile')
+        with open(join(ua.path, changed_name), 'wb') as fh:
+            fh.write('APPL????changed')
+        os.unlink(join(ua.path, deleted_name))
+        with open(join(app_dir, 'NewFile'), 'wb') as fh:
+            fh.write('new')
+        output_path = self.get_temp_file() + '.ipa'
+        try:
+            ua.archive(output_path)
+            original = zipfile.ZipFile(self.TEST_IPA)
+            repacked = zipfile.ZipFile(output_path)
+            assert repacked.testzip() is None
+            assert repacked.read(changed_name) == 'APPL????changed'
+            assert repacked.read(new_name) == 'new'
+            assert deleted_name not in repacked.namelist()
+            for info in original.infolist():
+                if info.filename in (changed_name, deleted_name):
+                    continue
+                repacked_info = repacked.getinfo(info.filename)
+                assert repacked_info.compress_size == info.compress_size
+                assert repacked_info.CRC == info.CRC
+                assert repacked_info.date_time == info.date_time
+                assert repacked_info.external_attr == info.external_attr
+        finally:
+            ua.remove()
+            self.unlink(output_path)
+
+    def test_repack_without_zipfile_internals(self):
+        """ if zipfile lacks what we need to copy raw, we recompress """
+        ua = self._unarchive(self.TEST_IPA, True)
+        output_path = self.get_temp_file() + '.ipa'
+        def copy_member_raw(source_zipfile_obj, info, zipfile_obj):
+            raise AttributeError("'module' object has no attribute '_FH_FILENAME_LENGTH'")
+        original_copy_member_raw = native_zip.copy_member_raw
+        native_zip.copy_member_raw = copy_member_raw
+        try:
+            try:
+                ua.archive(output_path)
+            finally:
+                native_zip.copy_member_raw = original_copy_member_raw
+            original = zipfile.ZipFile(self.TEST_IPA)
+            repacked = zipfile.ZipFile(output_path)
+            assert repacked.testzip() is None
+            assert set(repacked.namelist()) == set(original.namelist())
+            for info in original.infolist():
+                repacked_info = repacked.getinfo(info.filename)
+                assert repacked.read(info.filename) == original.read(info.filename)
+                assert repacked_info.external_attr == info.external_attr
+        finally:
+            ua.remove()
+            self.unlink(output_path)
+
+    def _make_seal(self, ua):
+        bundle = ua.bundle
+        seal_path = make_seal(bundle.get_executable_path(),
+                              bundle.path,
+                              bundle.hasher)
+        with open(seal_path, 'rb') as fh:
+            return fh.read()
+
+    def test_selective_extract_matches_full(self):
+        ua = self._unarchive(self.TEST_IPA, True)
+        archive = archive_factory(self.TEST_IPA)
+        archive.selective_extract = True
+        selective_ua = archive.unarchive_to_temp()
+        output_path = self.get_temp_file() + '.ipa'
+        try:
+            tree = self._get_tree(selective_ua.path)
+            assert len(tree) < len(self._get_tree(ua.path))
+            assert 'Payload/Test.app/Info.plist' in tree
+            assert 'Payload/Test.app/isignTestApp' in tree
+            assert 'Payload/Test.app/Assets.car' not in tree
+
+            assert self._make_seal(selective_ua) == self._make_seal(ua)
+
+            selective_ua.archive(output_path)
+            original = zipfile.ZipFile(self.TEST_IPA)
+            repacked = zipfile.ZipFile(output_path)
+            assert repacked.testzip() is None
+            assert set(repacked.namelist()) == set(original.namelist())
+        finally:
+            ua.remove()
+            selective_ua.remove()
+            self.unlink(output_path)
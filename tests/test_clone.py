@@ -0,0 +1,66 @@
+from isign_base_test import IsignBaseTest
+from isign import clone, isign
+from isign.archive import archive_factory
+from isign.signer import Signer
+import hashlib
+import os
+from os.path import join, relpath
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def get_tree_digests(path):
+    digests = {}
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = join(root, filename)
+            with open(file_path, 'rb') as fh:
+                digests[relpath(file_path, path)] = hashlib.sha1(fh.read()).hexdigest()
+    return digests
+
+
+class TestClone(IsignBaseTest):
+
+    def test_clone(self):
+        """ whichever way works here, we get the same files """
+        target = join(self.get_temp_dir(), 'clone')
+        try:
+            method = clone.clone_tree(self.TEST_UNSIGNED_FAT_APP, target)
+            assert method in clone.CLONE_METHODS
+            assert (get_tree_digests(target) ==
+                    get_tree_digests(self.TEST_UNSIGNED_FAT_APP))
+        finally:
+            self.unlink(os.path.dirname(target))
+
+    def test_hardlink(self):
+        """ only what isign rewrites gets copied """
+        target = join(self.get_temp_dir(), 'clone')
+        try:
+            assert clone.clone_tree(self.TEST_UNSIGNED_FAT_APP, target,
+                                    ['hardlink']) == 'hardlink'
+            for name in ['Info.plist', 'isignTestApp',
+                         join('Frameworks', 'libswiftUIKit.dylib')]:
+                assert os.stat(join(target, name)).st_nlink == 1
+            assert os.stat(join(target, 'Assets.car')).st_nlink > 1
+        finally:
+            self.unlink(os.path.dirname(target))
+
+    def test_signing_hardlinked_clone(self):
+        """ signing a hardlinked clone leaves the original alone """
+        ua = archive_factory(self.TEST_IPA).unarchive_to_temp()
+        ua.clone_methods = ['hardlink']
+        clone_ua = None
+        try:
+            before = get_tree_digests(ua.path)
+            clone_ua = ua.clone(ua.path + '_1')
+            signer = Signer(signer_key_file=self.KEY,
+                            signer_cert_file=self.CERTIFICATE,
+                            apple_cert_file=isign.DEFAULT_APPLE_CERT_PATH)
+            clone_ua.bundle.resign(True, signer, self.PROVISIONING_PROFILE)
+            assert get_tree_digests(ua.path) == before
+            assert get_tree_digests(clone_ua.path) != before
+        finally:
+            ua.remove()
+            if clone_ua is not None:
+                clone_ua.remove()
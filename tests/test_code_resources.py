@@ -0,0 +1,215 @@
+from isign_base_test import IsignBaseTest
+from isign import code_resources
+from isign.archive import archive_factory
+import hashlib
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+from os.path import join
+import plistlib
+
+log = logging.getLogger(__name__)
+
+
+class TestPriorSeal(IsignBaseTest):
+    """ Reusing digests from the seal an app already had """
+
+    def _get_seal_path(self, ua):
+        return join(ua.bundle.path,
+                    code_resources.OUTPUT_DIRECTORY,
+                    code_resources.OUTPUT_FILENAME)
+
+    def _unarchive(self):
+        archive = archive_factory(self.TEST_IPA)
+        archive.reuse_prior_seal = True
+        return archive.unarchive_to_temp()
+
+    def _plant_wrong_digests(self, ua, relative_paths):
+        """ Tamper with the existing seal, so we can tell whether a digest was
+            reused from it, or computed afresh """
+        seal_path = self._get_seal_path(ua)
+        plist = plistlib.readPlist(seal_path)
+        wrong_digest = plistlib.Data('\x00' * 20)
+        for relative_path in relative_paths:
+            plist['files'][relative_path] = wrong_digest
+        plistlib.writePlist(plist, seal_path)
+
+    def _make_seal(self, ua):
+        bundle = ua.bundle
+        code_resources.make_seal(bundle.get_executable_path(),
+                                 bundle.path,
+                                 bundle.hasher)
+        return plistlib.readPlist(self._get_seal_path(ua))
+
+    def test_reuses_digests_of_untouched_files(self):
+        ua = self._unarchive()
+        try:
+            assert ua.bundle.hasher.snapshot is not None
+            self._plant_wrong_digests(ua, ['Assets.car', 'PkgInfo'])
+            # touch one of the files, so it must be hashed again
+            with open(join(ua.bundle.path, 'PkgInfo'), 'ab') as fh:
+                fh.write('!')
+            plist = self._make_seal(ua)
+            assert plist['files']['Assets.car'].data == '\x00' * 20
+            assert plist['files']['PkgInfo'].data != '\x00' * 20
+        finally:
+            ua.remove()
+
+    def test_verify_prior_seal(self):
+        ua = self._unarchive()
+        old_verify = code_resources.VERIFY_PRIOR_SEAL
+        code_resources.VERIFY_PRIOR_SEAL = True
+        try:
+            self._plant_wrong_digests(ua, ['Assets.car'])
+            plist = self._make_seal(ua)
+            assert plist['files']['Assets.car'].data != '\x00' * 20
+        finally:
+            code_resources.VERIFY_PRIOR_SEAL = old_verify
+            ua.remove()
+
+    def test_no_snapshot_means_no_reuse(self):
+        archive = archive_factory(self.TEST_IPA)
+        ua = archive.unarchive_to_temp()
+        try:
+            assert ua.bundle.hasher.snapshot is None
+            self._plant_wrong_digests(ua, ['Assets.car'])
+            plist = self._make_seal(ua)
+            assert plist['files']['Assets.car'].data != '\x00' * 20
+        finally:
+            ua.remove()
+
+
+class TestKnownDigests(IsignBaseTest):
+    """ Digests hashed once, for several copies of an app """
+
+    def _make_seal(self, ua):
+        bundle = ua.bundle
+        code_resources.make_seal(bundle.get_executable_path(),
+                                 bundle.path,
+                                 bundle.hasher)
+        return plistlib.readPlist(join(bundle.path,
+                                       code_resources.OUTPUT_DIRECTORY,
+                                       code_resources.OUTPUT_FILENAME))
+
+    def test_clones_reuse_digests(self):
+        ua = archive_factory(self.TEST_IPA).unarchive_to_temp()
+        clone_ua = None
+        try:
+            ua.hash_resources()
+            assert 'Info.plist' not in [os.path.basename(relative_path)
+                                        for relative_path in ua.known_digests]
+            # plant wrong digests, so we can tell if they're used
+            for relative_path, (state, digest) in ua.known_digests.items():
+                if os.path.basename(relative_path) in ['Assets.car', 'PkgInfo']:
+                    ua.known_digests[relative_path] = (state, '\x00' * 20)
+            clone_ua = ua.clone(ua.path + '_1')
+            # touch one of the files, so it must be hashed again
+            with open(join(clone_ua.bundle.path, 'PkgInfo'), 'ab') as fh:
+                fh.write('!')
+            plist = self._make_seal(clone_ua)
+            assert plist['files']['Assets.car'].data == '\x00' * 20
+            assert plist['files']['PkgInfo'].data != '\x00' * 20
+        finally:
+            ua.remove()
+            if clone_ua is not None:
+                clone_ua.remove()
+
+
+class TestResourceBuilder(IsignBaseTest):
+
+    def test_scan_files_and_files2(self):
+        app_path = join(self.TEST_APP, 'isignTestApp')
+        template = code_resources.get_template()
+        builder = code_resources.ResourceBuilder(app_path, template['rules2'])
+        files, files2 = builder.scan()
+        # Info.plist is omitted from files2 by the rules, but still in files
+        assert 'Info.plist' in files
+        assert 'Info.plist' not in files2
+        assert 'isignTestApp' not in files
+        assert set(files2) < set(files)
+        for relative_path, val in files2.iteritems():
+            assert files[relative_path] == val
+
+    def test_hash_workers_give_same_seal(self):
+        app_path = join(self.TEST_APP, 'isignTestApp')
+        template = code_resources.get_template()
+        serial = code_resources.ResourceBuilder(app_path, template['rules2'])
+        hasher = code_resources.ResourceHasher(workers=4)
+        parallel = code_resources.ResourceBuilder(app_path, template['rules2'],
+                                                  hasher=hasher)
+        assert parallel.scan() == serial.scan()
+
+    def test_hash_pool_class(self):
+        """ a pool class can be used instead of threads """
+        app_path = join(self.TEST_APP, 'isignTestApp')
+        template = code_resources.get_template()
+        serial = code_resources.ResourceBuilder(app_path, template['rules2'])
+        hasher = code_resources.ResourceHasher(workers=4)
+        hasher.pool_class = ThreadPool
+        pooled = code_resources.ResourceBuilder(app_path, template['rules2'],
+                                                hasher=hasher)
+        assert pooled.scan() == serial.scan()
+
+
+class TestHashCache(IsignBaseTest):
+
+    def _write(self, path, data):
+        with open(path, 'wb') as fh:
+            fh.write(data)
+
+    def test_hits_and_eviction(self):
+        cache = code_resources.HashCache(max_size=2)
+        cache.put(('a', 1, 1, 1.0), 'A')
+        cache.put(('b', 1, 1, 1.0), 'B')
+        assert cache.get(('a', 1, 1, 1.0)) == 'A'
+        # b is now least recently used, so goes first
+        cache.put(('c', 1, 1, 1.0), 'C')
+        assert cache.get(('b', 1, 1, 1.0)) is None
+        assert cache.get(('c', 1, 1, 1.0)) == 'C'
+        # same path, different file. The stale entry is dropped
+        assert cache.get(('a', 2, 1, 1.0)) is None
+        assert len(cache) == 1
+        assert cache.hits == 2
+        assert cache.misses == 2
+
+    def test_rewritten_file_is_hashed_again(self):
+        path = self.get_temp_file()
+        try:
+            self._write(path, 'one')
+            os.utime(path, (1000, 1000))
+            assert code_resources.get_hash_hex(path) == hashlib.sha1('one').hexdigest()
+            # same size and mtime, so only invalidation can tell
+            self._write(path, 'two')
+            os.utime(path, (1000, 1000))
+            code_resources.invalidate_hash(path)
+            assert code_resources.get_hash_hex(path) == hashlib.sha1('two').hexdigest()
+            # different size, no invalidation needed
+            self._write(path, 'three')
+            assert code_resources.get_hash_hex(path) == hashlib.sha1('three').hexdigest()
+        finally:
+            os.unlink(path)
+
+
+class TestRuleMatcher(IsignBaseTest):
+
+    def test_rule_matcher_agrees_with_linear(self):
+        paths = ['Info.plist', 'PkgInfo', 'version.plist', 'foo.png',
+                 'embedded.provisionprofile', 'Base.lproj/Main.storyboardc',
+                 'en.lproj/locversion.plist', 'en.lproj/Foo.strings',
+                 'Frameworks/Foo.framework/Foo', 'PlugIns/Ext.appex/Ext',
+                 'Library/Spotlight/Foo', 'Foo.app.dSYM/Contents',
+                 'sub/dir/.DS_Store', '.DS_Store', 'sub/dir/thing.nib',
+                 'INFO.PLIST', 'EN.LPROJ/x']
+        template = code_resources.get_template()
+        for key in ['rules', 'rules2']:
+            builder = code_resources.ResourceBuilder('/tmp/x.app/x',
+                                                     template[key])
+            assert builder.rule_matcher.is_combined()
+            for path in paths:
+                assert builder.find_rule(path) is builder.find_rule_linear(path)
+
+    def test_rule_matcher_falls_back(self):
+        rules = {r'^(a)\1$': {'weight': 10.0}, '^b': {'weight': 5.0}}
+        builder = code_resources.ResourceBuilder('/tmp/x.app/x', rules)
+        assert not builder.rule_matcher.is_combined()
+        assert builder.find_rule('aa').weight == 10.0
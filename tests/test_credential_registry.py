@@ -0,0 +1,60 @@
+from isign_base_test import IsignBaseTest
+from isign import isign
+from isign.credential_registry import CredentialRegistry
+from isign.exceptions import MissingCredentials
+import os
+from os.path import exists, join
+import shutil
+import tempfile
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TestCredentialRegistry(IsignBaseTest):
+
+    def test_get(self):
+        registry = CredentialRegistry()
+        assert registry.load([self.CREDENTIALS_DIR, self.CREDENTIALS_DIR_2]) == {}
+        assert len(registry) == 2
+        credentials = registry.get(self.CREDENTIALS_DIR)
+        assert credentials is registry.get(self.CREDENTIALS_DIR)
+        assert credentials.signer._get_team_id() == self.OU
+        assert credentials.provisioning_profile == join(self.CREDENTIALS_DIR,
+                                                        'isign.mobileprovision')
+
+    def test_bad_dir(self):
+        registry = CredentialRegistry()
+        credentials_dir = join(self.TEST_DIR, 'credentials')
+        failures = registry.load([credentials_dir, self.CREDENTIALS_DIR])
+        assert isinstance(failures[credentials_dir], MissingCredentials)
+        assert self.CREDENTIALS_DIR in registry
+        with self.assertRaises(MissingCredentials):
+            registry.get(credentials_dir)
+
+    def test_reload(self):
+        """ if a file changes, we load them all again """
+        credentials_dir = tempfile.mkdtemp()
+        try:
+            for name in os.listdir(self.CREDENTIALS_DIR):
+                shutil.copy2(join(self.CREDENTIALS_DIR, name), credentials_dir)
+            registry = CredentialRegistry()
+            credentials = registry.get(credentials_dir)
+            cert_path = join(credentials_dir, 'certificate.pem')
+            st = os.stat(cert_path)
+            os.utime(cert_path, (st.st_atime, st.st_mtime + 10))
+            assert registry.get(credentials_dir) is not credentials
+        finally:
+            shutil.rmtree(credentials_dir)
+
+    def test_resign(self):
+        registry = CredentialRegistry()
+        output_path = self.get_temp_file()
+        isign.resign_with_creds_dir(self.TEST_IPA,
+                                    self.CREDENTIALS_DIR,
+                                    registry=registry,
+                                    output_path=output_path)
+        assert exists(output_path)
+        assert os.path.getsize(output_path) > 0
+        assert self.CREDENTIALS_DIR in registry
+        self.unlink(output_path)
@@ -0,0 +1,123 @@
+from isign_base_test import IsignBaseTest
+from isign import code_resources, digest_store
+from isign.archive import archive_factory
+import logging
+import os
+import plistlib
+import sqlite3
+
+log = logging.getLogger(__name__)
+
+
+class TestDigestStore(IsignBaseTest):
+
+    def setUp(self):
+        self.store_path = self.get_temp_file()
+        self.store = digest_store.DigestStore(self.store_path, max_entries=2)
+
+    def tearDown(self):
+        self.store.close()
+        os.unlink(self.store_path)
+
+    def test_get_and_put(self):
+        assert self.store.get('a') is None
+        self.store.put('a', '\x01' * 20)
+        assert self.store.get('a') == '\x01' * 20
+        assert self.store.hits == 1
+        assert self.store.misses == 1
+
+    def test_collision(self):
+        self.store.put('a', '\x01' * 20)
+        self.store.put('a', '\x02' * 20)
+        # we can't trust that fingerprint any more, even for the first digest
+        assert self.store.get('a') is None
+        self.store.put('a', '\x01' * 20)
+        assert self.store.get('a') is None
+
+    def test_prune(self):
+        for fingerprint in ['a', 'b', 'c']:
+            self.store.put(fingerprint, '\x01' * 20)
+        self.store.get('a')
+        assert self.store.prune() == 1
+        assert len(self.store) == 2
+        assert self.store.get('a') is not None
+        assert self.store.get('b') is None
+
+    def test_persists(self):
+        self.store.put('a', '\x01' * 20)
+        self.store.close()
+        self.store = digest_store.DigestStore(self.store_path)
+        assert self.store.get('a') == '\x01' * 20
+
+    def test_shared(self):
+        """ two jobs can use the same store at once """
+        other = digest_store.DigestStore(self.store_path)
+        try:
+            self.store.put('a', '\x01' * 20)
+            other.put('b', '\x02' * 20)
+            assert self.store.get('b') == '\x02' * 20
+            assert other.get('a') == '\x01' * 20
+        finally:
+            other.close()
+
+    def test_busy(self):
+        """ if someone else is writing, we carry on without the store """
+        self.store.put('a', '\x01' * 20)
+        writer = sqlite3.connect(self.store_path)
+        try:
+            writer.execute('BEGIN EXCLUSIVE')
+            self.store.put('b', '\x02' * 20)
+            assert self.store.get('a') in ('\x01' * 20, None)
+        finally:
+            writer.rollback()
+            writer.close()
+        assert self.store.get('b') is None
+        self.store.put('b', '\x02' * 20)
+        assert self.store.get('b') == '\x02' * 20
+
+    def _seal(self):
+        archive = archive_factory(self.TEST_IPA)
+        ua = archive.unarchive_to_temp()
+        try:
+            ua.bundle.hasher.digest_store = self.store
+            bundle = ua.bundle
+            seal_path = code_resources.make_seal(bundle.get_executable_path(),
+                                                 bundle.path,
+                                                 bundle.hasher)
+            return plistlib.readPlist(seal_path)
+        finally:
+            ua.remove()
+
+    def test_seal_with_store(self):
+        old_min_size = digest_store.MIN_SIZE
+        digest_store.MIN_SIZE = 0
+        self.store.max_entries = digest_store.DEFAULT_MAX_ENTRIES
+        try:
+            first = self._seal()
+            assert self.store.hits == 0
+            assert len(self.store) > 0
+            second = self._seal()
+            assert self.store.hits > 0
+            assert first == second
+        finally:
+            digest_store.MIN_SIZE = old_min_size
+
+    def test_resign_uses_store_only_for_zips(self):
+        old_min_size = digest_store.MIN_SIZE
+        digest_store.MIN_SIZE = 0
+        self.store.close()
+        try:
+            for filename, used in [(self.TEST_APP, False), (self.TEST_IPA, True)]:
+                os.unlink(self.store_path)
+                output_path = self.get_temp_file()
+                try:
+                    self.resign(filename, output_path=output_path,
+                                digest_store_path=self.store_path)
+                finally:
+                    self.unlink(output_path)
+                self.store = digest_store.DigestStore(self.store_path)
+                assert (len(self.store) > 0) == used
+                self.store.close()
+        finally:
+            digest_store.MIN_SIZE = old_min_size
+            self.store = digest_store.DigestStore(self.store_path)
@@ -12,6 +12,12 @@ log = logging.getLogger(__name__)
 class MissingHelpersArchive(AppZipArchive):
     """ An App whose helpers are not present """
     helpers = ['a_file_that_should_never_be_present']
+    use_native_zip = False
+
+
+class NativeMissingHelpersArchive(MissingHelpersArchive):
+    """ An App whose helpers are not present, but doesn't need them """
+    use_native_zip = True
 
 
 def dummy_find_executable(name):
@@ -34,3 +40,7 @@ class TestHelpers(IsignBaseTest):
         if hasattr(spawn, '_original_find_executable'):
             spawn.find_executable = spawn._original_find_executable
         isign.archive.helper_paths = {}
+
+    def test_helpers_not_needed_for_native_zip(self):
+        """ test that missing helpers don't matter if we zip in-process """
+        assert NativeMissingHelpersArchive.precheck(self.TEST_APPZIP)
@@ -0,0 +1,53 @@
+from isign_base_test import IsignBaseTest
+from isign import makesig
+import hashlib
+import os
+
+
+class TestHashPages(IsignBaseTest):
+
+    def _expected_hashes(self, data, arch_offset, header_data, code_limit):
+        """ the simple way: build the whole slice in memory """
+        actual_data = header_data + data[arch_offset + len(header_data):
+                                         arch_offset + code_limit]
+        actual_data += '\x00' * (code_limit - len(actual_data))
+        return [hashlib.sha1(actual_data[i:i + makesig.PAGE_SIZE]).digest()
+                for i in xrange(0, code_limit, makesig.PAGE_SIZE)]
+
+    def test_hash_pages(self):
+        data = os.urandom(5 * makesig.PAGE_SIZE + 100)
+        path = self.get_temp_file()
+        try:
+            with open(path, 'wb') as f:
+                f.write(data)
+            header_data = 'H' * (makesig.PAGE_SIZE + 10)
+            cases = [(0, len(data)),
+                     (0, len(data) + 12),  # past the end of the file
+                     (makesig.PAGE_SIZE, 2 * makesig.PAGE_SIZE + 1)]
+            with open(path, 'rb') as f:
+                for arch_offset, code_limit in cases:
+                    hashes = makesig.hash_pages(f, arch_offset, header_data,
+                                                code_limit)
+                    assert hashes == self._expected_hashes(data, arch_offset,
+                                                           header_data,
+                                                           code_limit)
+        finally:
+            os.unlink(path)
+
+    def test_hash_pages_in_parallel(self):
+        data = os.urandom(37 * makesig.PAGE_SIZE + 5)
+        path = self.get_temp_file()
+        old_min_pages = makesig.PARALLEL_MIN_PAGES
+        makesig.PARALLEL_MIN_PAGES = 1
+        try:
+            with open(path, 'wb') as f:
+                f.write(data)
+            header_data = 'H' * 100
+            with open(path, 'rb') as f:
+                serial = makesig.hash_pages(f, 0, header_data, len(data), 1)
+                parallel = makesig.hash_pages(f, 0, header_data, len(data), 4)
+            assert parallel == serial
+            assert len(parallel) == 38
+        finally:
+            makesig.PARALLEL_MIN_PAGES = old_min_pages
+            os.unlink(path)
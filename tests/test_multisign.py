@@ -1,7 +1,9 @@
 from isign_base_test import IsignBaseTest
+from isign import isign
+from isign.exceptions import MissingCredentials
 import os
-from os.path import exists
-from isign.multisign import multisign
+from os.path import exists, join
+from isign.multisign import multisign, multisign_iter, SigningPool
 import logging
 
 log = logging.getLogger(__name__)
@@ -22,3 +24,61 @@ class TestMultisign(IsignBaseTest):
             assert exists(output_path)
             assert os.path.getsize(output_path) > 0
             self.unlink(output_path)
+
+    def test_multisign_iter(self):
+        """ one bad credential directory doesn't spoil the others """
+        output_path1 = self.get_temp_file()
+        output_path2 = self.get_temp_file()
+        bad_credentials_dir = join(self.TEST_DIR, 'credentials')
+        creds_dir_to_output_paths = {
+            self.CREDENTIALS_DIR: output_path1,
+            bad_credentials_dir: output_path2
+        }
+        results = {}
+        for cred_dir, output_path, error, timings in multisign_iter(
+                self.TEST_IPA, creds_dir_to_output_paths):
+            results[cred_dir] = (output_path, error, timings)
+        assert results[self.CREDENTIALS_DIR][0] == output_path1
+        assert results[self.CREDENTIALS_DIR][1] is None
+        assert set(results[self.CREDENTIALS_DIR][2]) == set(['sign', 'archive', 'total'])
+        assert exists(output_path1)
+        assert isinstance(results[bad_credentials_dir][1], MissingCredentials)
+        assert not exists(output_path2)
+        self.unlink(output_path1)
+
+    def test_signing_pool(self):
+        """ a pool can be reused, for multisign and for single resigns """
+        with SigningPool(2, cred_dirs=[self.CREDENTIALS_DIR],
+                         maxtasksperchild=1) as pool:
+            for _ in range(2):
+                output_path1 = self.get_temp_file()
+                output_path2 = self.get_temp_file()
+                creds_dir_to_output_paths = {
+                    self.CREDENTIALS_DIR: output_path1,
+                    self.CREDENTIALS_DIR_2: output_path2
+                }
+                results = multisign(self.TEST_IPA, creds_dir_to_output_paths,
+                                    pool=pool)
+                assert len(results) == 2
+                for output_path in [output_path1, output_path2]:
+                    assert exists(output_path)
+                    self.unlink(output_path)
+            # single resigns run side by side
+            output_paths = [self.get_temp_file() for _ in range(2)]
+            async_results = [pool.resign_with_creds_dir(self.TEST_IPA,
+                                                        self.CREDENTIALS_DIR,
+                                                        output_path=output_path)
+                             for output_path in output_paths]
+            async_results.append(pool.resign(self.TEST_NONAPP_TXT,
+                                             key=self.KEY,
+                                             certificate=self.CERTIFICATE,
+                                             provisioning_profile=self.PROVISIONING_PROFILE,
+                                             output_path=self.get_temp_file()))
+            for async_result in async_results[:2]:
+                async_result.get()
+            with self.assertRaises(isign.NotSignable):
+                async_results[2].get()
+            for output_path in output_paths:
+                assert exists(output_path)
+                self.unlink(output_path)
+        assert pool.closed
@@ -0,0 +1,64 @@
+from isign_base_test import IsignBaseTest
+from isign import provisioning_profile
+from isign.signer import openssl_command
+import datetime
+import shutil
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TestProvisioningProfile(IsignBaseTest):
+
+    def test_same_as_openssl(self):
+        with open(self.PROVISIONING_PROFILE, 'rb') as fh:
+            data = fh.read()
+        content = provisioning_profile.get_signed_content(data)
+        assert content.startswith('<?xml')
+        assert content == provisioning_profile.get_signed_content_with_openssl(
+            self.PROVISIONING_PROFILE)
+
+    def test_indefinite_length(self):
+        """ BER envelopes, as made by streaming signers, decode too """
+        content = provisioning_profile.get_signed_content_with_openssl(
+            self.PROVISIONING_PROFILE)
+        content_path = self.get_temp_file()
+        ber_path = self.get_temp_file()
+        try:
+            with open(content_path, 'wb') as fh:
+                fh.write(content)
+            openssl_command(['cms', '-sign', '-nodetach', '-stream', '-binary',
+                             '-in', content_path, '-out', ber_path,
+                             '-signer', self.CERTIFICATE, '-inkey', self.KEY,
+                             '-outform', 'DER'])
+            with open(ber_path, 'rb') as fh:
+                data = fh.read()
+            # indefinite length
+            assert data[1] == '\x80'
+            assert provisioning_profile.get_signed_content(data) == content
+        finally:
+            self.unlink(content_path)
+            self.unlink(ber_path)
+
+    def test_cache(self):
+        cache = provisioning_profile.ProfileCache(2)
+        profile = cache.get(self.PROVISIONING_PROFILE)
+        assert profile.team_ids == [self.OU]
+        assert profile.entitlements['application-identifier'] == 'ISIGNTESTS.*'
+        assert isinstance(profile.expiration_date, datetime.datetime)
+        assert len(profile.devices) > 0
+        assert cache.misses == 1
+
+        # a copy is the same profile
+        copy_path = self.get_temp_file()
+        try:
+            shutil.copyfile(self.PROVISIONING_PROFILE, copy_path)
+            assert cache.get(copy_path) is profile
+            assert cache.hits == 1
+            # but not once it changes
+            with open(copy_path, 'ab') as fh:
+                fh.write('\x00')
+            assert cache.get(copy_path) is not profile
+            assert len(cache) == 2
+        finally:
+            self.unlink(copy_path)
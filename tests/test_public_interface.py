@@ -2,6 +2,8 @@ from isign_base_test import IsignBaseTest
 import os
 from os.path import exists
 from isign import isign
+from isign.bundle import Bundle
+from isign.signable import Signable
 import logging
 
 log = logging.getLogger(__name__)
@@ -26,6 +28,30 @@ class TestPublicInterface(IsignBaseTest):
     def test_app_ipa(self):
         self._test_signable(self.TEST_IPA, self.get_temp_file())
 
+    def test_app_ipa_not_in_place(self):
+        Signable.sign_in_place = False
+        try:
+            self._test_signable(self.TEST_IPA, self.get_temp_file())
+        finally:
+            Signable.sign_in_place = True
+
+    def test_unsigned_fat_app(self):
+        self._test_signable(self.TEST_UNSIGNED_FAT_APP, self.get_temp_dir())
+
+    def test_unsigned_fat_app_one_slice_at_a_time(self):
+        Signable.concurrent_slices = False
+        try:
+            self._test_signable(self.TEST_UNSIGNED_FAT_APP, self.get_temp_dir())
+        finally:
+            Signable.concurrent_slices = True
+
+    def test_unsigned_fat_app_one_component_at_a_time(self):
+        Bundle.sign_workers = 1
+        try:
+            self._test_signable(self.TEST_UNSIGNED_FAT_APP, self.get_temp_dir())
+        finally:
+            Bundle.sign_workers = 4
+
     def test_app_with_frameworks_ipa(self):
         self._test_signable(self.TEST_WITH_FRAMEWORKS_IPA, self.get_temp_file())
 
@@ -40,3 +66,19 @@ class TestPublicInterface(IsignBaseTest):
 
     def test_simulator_app(self):
         self._test_unsignable(self.TEST_SIMULATOR_APP, self.get_temp_file())
+
+    def test_resign_many(self):
+        inputs = [self.TEST_IPA, self.TEST_NONAPP_TXT, self.TEST_APPZIP]
+        outputs = [self.get_temp_file() for _ in inputs]
+        results = isign.resign_many(inputs, outputs,
+                                    key=self.KEY,
+                                    certificate=self.CERTIFICATE,
+                                    provisioning_profile=self.PROVISIONING_PROFILE)
+        assert [result[:2] for result in results] == zip(inputs, outputs)
+        assert results[0][2] is None
+        assert isinstance(results[1][2], isign.NotSignable)
+        assert results[2][2] is None
+        for output_path in outputs:
+            if output_path != outputs[1]:
+                assert os.path.getsize(output_path) > 0
+            self.unlink(output_path)
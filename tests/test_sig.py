@@ -1,6 +1,9 @@
 import isign
 from isign_base_test import IsignBaseTest
+from nose.plugins.skip import SkipTest
+import os
 from os.path import join
+import tempfile
 
 
 class TestSigner(IsignBaseTest):
@@ -8,6 +11,7 @@ class TestSigner(IsignBaseTest):
     def test_bad_signature(self):
         """ make openssl appear to return a bad signature """
         old_openssl = isign.signer.OPENSSL
+        isign.signer.Signer.in_process_cms = False
         try:
             signer = isign.signer.Signer(
                 signer_key_file=self.KEY,
@@ -18,3 +22,59 @@ class TestSigner(IsignBaseTest):
                 signer.sign("some data")
         finally:
             isign.signer.OPENSSL = old_openssl
+            isign.signer.Signer.in_process_cms = True
+
+    def test_signature_size(self):
+        """ the room we reserve for signatures must be enough """
+        signer = isign.signer.Signer(
+            signer_key_file=self.KEY,
+            signer_cert_file=self.CERTIFICATE,
+            apple_cert_file=isign.isign.DEFAULT_APPLE_CERT_PATH)
+        assert len(signer.sign("some data")) <= signer.get_signature_size()
+        assert isign.signer.AdhocSigner().get_signature_size() == 0
+
+    def test_credentials(self):
+        """ credentials are read once, and can be shared by Signers """
+        credentials = isign.signer.Credentials.load(
+            self.KEY, self.CERTIFICATE, isign.isign.DEFAULT_APPLE_CERT_PATH)
+        assert credentials.common_name == 'isign_tests'
+        assert credentials.team_id == 'ISIGNTESTS'
+        assert len(credentials.chain_der) > 0
+        with self.assertRaises(AttributeError):
+            credentials.team_id = 'OTHER'
+        signer = isign.signer.Signer(credentials=credentials)
+        assert signer.get_common_name() == 'isign_tests'
+        assert signer._get_team_id() == 'ISIGNTESTS'
+        assert signer.get_signature_size() == credentials.signature_size
+
+    def test_missing_credentials(self):
+        with self.assertRaises(isign.exceptions.MissingCredentials):
+            isign.signer.Signer(signer_key_file=self.KEY,
+                                signer_cert_file='/nonexistent',
+                                apple_cert_file=isign.isign.DEFAULT_APPLE_CERT_PATH)
+
+    def test_in_process_signature_verifies(self):
+        """ openssl must accept the signatures we make without it """
+        if isign.signer.pkcs7 is None:
+            raise SkipTest("cryptography is too old to sign in-process")
+        signer = isign.signer.Signer(
+            signer_key_file=self.KEY,
+            signer_cert_file=self.CERTIFICATE,
+            apple_cert_file=isign.isign.DEFAULT_APPLE_CERT_PATH)
+        data = "some data\x00\xff\r\n"
+        signature = signer._sign_in_process(data)
+        fd, signature_path = tempfile.mkstemp()
+        os.write(fd, signature)
+        os.close(fd)
+        fd, data_path = tempfile.mkstemp()
+        os.write(fd, data)
+        os.close(fd)
+        try:
+            cmd = ['cms', '-verify', '-noverify', '-binary',
+                   '-inform', 'DER', '-in', signature_path,
+                   '-content', data_path]
+            out, _ = isign.signer.openssl_command(cmd, expect_err=True)
+            assert out == data
+        finally:
+            os.unlink(signature_path)
+            os.unlink(data_path)
@@ -0,0 +1,48 @@
+from isign_base_test import IsignBaseTest
+from isign import utils
+
+
+class TestMapThreaded(IsignBaseTest):
+
+    def test_order(self):
+        items = range(50)
+        assert utils.map_threaded(lambda x: x * 2, items, 4) == [x * 2 for x in items]
+        assert utils.map_threaded(lambda x: x, []) == []
+
+    def test_exception(self):
+        def fail_on_3(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+        with self.assertRaises(ValueError):
+            utils.map_threaded(fail_on_3, range(10), 3)
+
+
+class TestRunPipeline(IsignBaseTest):
+
+    def test_stages_in_order(self):
+        items = [[i] for i in range(20)]
+        finished = []
+        errors = utils.run_pipeline(items,
+                                    [lambda item: item.append('a'),
+                                     lambda item: item.append('b'),
+                                     lambda item: item.append('c')],
+                                    finish=finished.append)
+        assert errors == [None] * 20
+        assert items == [[i, 'a', 'b', 'c'] for i in range(20)]
+        assert finished == items
+
+    def test_failure_skips_later_stages(self):
+        def fail_on_3(item):
+            if item[0] == 3:
+                raise ValueError(item)
+            item.append('a')
+        items = [[i] for i in range(5)]
+        finished = []
+        errors = utils.run_pipeline(items,
+                                    [fail_on_3, lambda item: item.append('b')],
+                                    finish=finished.append)
+        assert isinstance(errors[3], ValueError)
+        assert items[3] == [3]
+        assert items[4] == [4, 'a', 'b']
+        assert len(finished) == 5